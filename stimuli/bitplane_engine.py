@@ -0,0 +1,169 @@
+# ----------------------------------------------------------------------
+#
+# File: bitplane_engine.py
+#
+# Last edited: 17.10.2026
+#
+# Copyright (C) 2026, ETH Zurich and University of Bologna.
+#
+# Author: Moritz Scherer, ETH Zurich
+#
+# ----------------------------------------------------------------------
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the License); you may
+# not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an AS IS BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This module implements the ternary convolutions of the golden model in compute_tcn.py
+# on bit-planes, like tern_mult.sv, popc.sv and addertree.sv do in the OCUs. Every trit is
+# split into a nonzero bit and a sign bit, 64 trits are packed into one uint64 word each.
+# A product is nonzero if both nonzero bits are set and negative if the sign bits differ,
+# so a dot product is popcount(nonzero) - 2 * popcount(nonzero & negative).
+#
+# Where torch has an int8 matrix multiplication with int32 sums for the CPU, the convolution
+# windows are gathered as int8 trits and summed by it instead, which gives the same sums and
+# is faster than the float convolutions. The bit-plane kernel is the fallback.
+
+import numpy as np
+import torch
+
+# Number of output pixels whose products are computed at once
+chunksize = 1024
+
+def _find_int_mm():
+    # torch._int_mm does not have a CPU kernel in every torch version
+    try:
+        torch._int_mm(torch.zeros((17, 8), dtype=torch.int8), torch.zeros((8, 8), dtype=torch.int8))
+    except (AttributeError, RuntimeError):
+        return None
+    return torch._int_mm
+
+int_mm = _find_int_mm()
+
+_popcount_table = np.array([bin(j).count('1') for j in range(256)], dtype=np.uint8)
+
+def popcount(words):
+    # np.bitwise_count is only available from numpy 2.0 on
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(words)
+    return _popcount_table[words.view(np.uint8)].reshape(*words.shape, 8).sum(axis=-1, dtype=np.uint8)
+
+def pack_bitplanes(trits):
+    # trits is a (..., n) array, returns the nonzero and sign planes as (..., ceil(n/64)) uint64 arrays
+    trits = np.asarray(trits)
+    numwords = -(-trits.shape[-1] // 64)
+    planes = []
+    for plane in (trits != 0, trits < 0):
+        packed = np.packbits(plane, axis=-1)
+        padded = np.zeros((*packed.shape[:-1], numwords * 8), dtype=np.uint8)
+        padded[..., :packed.shape[-1]] = packed
+        planes.append(padded.view(np.uint64))
+    return planes[0], planes[1]
+
+def packed_matmul(acts, weights):
+    # acts are the (N, words) and weights the (O, words) nonzero and sign planes, returns the (N, O)
+    # integer dot products. Every word holds the products of 64 trits, the words are accumulated in turn.
+    acts_nonzero, acts_sign = acts
+    weights_nonzero, weights_sign = weights
+
+    sums = np.empty((acts_nonzero.shape[0], weights_nonzero.shape[0]), dtype=np.int64)
+    for start in range(0, acts_nonzero.shape[0], chunksize):
+        stop = min(start + chunksize, acts_nonzero.shape[0])
+        nonzero = np.empty((stop - start, weights_nonzero.shape[0]), dtype=np.uint64)
+        negative = np.empty_like(nonzero)
+        nonzero_count = np.zeros(nonzero.shape, dtype=np.int32)
+        negative_count = np.zeros(nonzero.shape, dtype=np.int32)
+        for j in range(acts_nonzero.shape[1]):
+            np.bitwise_and(acts_nonzero[start:stop, j, np.newaxis], weights_nonzero[np.newaxis, :, j], out=nonzero)
+            np.bitwise_xor(acts_sign[start:stop, j, np.newaxis], weights_sign[np.newaxis, :, j], out=negative)
+            np.bitwise_and(negative, nonzero, out=negative)
+            nonzero_count += popcount(nonzero)
+            negative_count += popcount(negative)
+        sums[start:stop] = nonzero_count - 2 * negative_count
+    return sums
+
+def int8_matmul(acts, weights):
+    # acts is (N, n), weights is (O, n), both int8 trits, returns the (N, O) integer dot products
+    sums = int_mm(torch.from_numpy(np.ascontiguousarray(acts)), torch.from_numpy(weights).T.contiguous())
+    return sums.numpy().astype(np.int64)
+
+def ternary_matmul(acts, weights):
+    # acts is (N, n), weights is (O, n), both ternary, returns the (N, O) integer dot products
+    if int_mm is not None:
+        return int8_matmul(_to_trits(acts), _to_trits(weights))
+    return packed_matmul(pack_bitplanes(acts), pack_bitplanes(weights))
+
+def _to_trits(x):
+    if torch.is_tensor(x):
+        x = x.detach().numpy()
+    return np.asarray(x).astype(np.int8)
+
+def _add_bias(sums, layer):
+    sums = torch.from_numpy(np.asarray(sums, dtype=np.float32))
+    if layer.bias is not None:
+        sums = sums + layer.bias.detach().reshape(1, -1, *([1] * (sums.ndim - 2)))
+    return sums
+
+def _gather_windows(plane, outshape, kernel_size, dilation, padding, stride):
+    # plane is a (B, H, W, D) batch, every pixel holds its trits or its packed words. Returns the
+    # (B*outh*outw, kh*kw*D) windows, ordered like (O, kh, kw, D) weights.
+    b, h, w, depth = plane.shape
+    padded = np.zeros((b, h + 2 * padding[0], w + 2 * padding[1], depth), dtype=plane.dtype)
+    padded[:, padding[0]:padding[0] + h, padding[1]:padding[1] + w] = plane
+
+    taps = [padded[:, i * dilation[0]:i * dilation[0] + stride[0] * (outshape[0] - 1) + 1:stride[0],
+                   j * dilation[1]:j * dilation[1] + stride[1] * (outshape[1] - 1) + 1:stride[1]]
+            for i in range(kernel_size[0]) for j in range(kernel_size[1])]
+    return np.stack(taps, axis=3).reshape(b * outshape[0] * outshape[1], -1)
+
+def _bitplane_conv(x, weights, kernel_size, dilation, padding, stride):
+    # x is a (B, C, H, W) batch and weights are (O, C, kh, kw), returns the (B, O, outh, outw) sums
+    # as float32, which holds them exactly
+    b, c, h, w = x.shape
+    outshape = [(n + 2 * p - d * (k - 1) - 1) // s + 1 for n, k, d, p, s in zip((h, w), kernel_size, dilation, padding, stride)]
+    x = _to_trits(x).transpose(0, 2, 3, 1)
+    weights = _to_trits(weights).transpose(0, 2, 3, 1)
+    sums = torch.empty((b, weights.shape[0], outshape[0], outshape[1]))
+
+    if int_mm is not None:
+        # The int8 windows of a few images at a time, so they never take more than chunksize rows
+        images = max(1, chunksize // (outshape[0] * outshape[1]))
+        weights = torch.from_numpy(weights.reshape(weights.shape[0], -1)).T.contiguous()
+        for start in range(0, b, images):
+            windows = _gather_windows(x[start:start + images], outshape, kernel_size, dilation, padding, stride)
+            chunk = int_mm(torch.from_numpy(windows), weights)
+            sums[start:start + images] = chunk.reshape(-1, outshape[0], outshape[1], weights.shape[1]).permute(0, 3, 1, 2)
+    else:
+        # The channels of every pixel are packed before the windows are gathered, so the windows
+        # are copied as packed words and not as trits
+        planes = pack_bitplanes(x)
+        patches = [_gather_windows(j, outshape, kernel_size, dilation, padding, stride) for j in planes]
+        weights = [j.reshape(j.shape[0], -1) for j in pack_bitplanes(weights)]
+        chunk = torch.from_numpy(packed_matmul(patches, weights))
+        sums[:] = chunk.reshape(b, outshape[0], outshape[1], -1).permute(0, 3, 1, 2)
+
+    return sums.numpy()
+
+def bitplane_conv2d(conv, x):
+    # Same result as conv(x) for an nn.Conv2d with ternary weights and zero padding
+    sums = _bitplane_conv(x, conv.weight, conv.kernel_size, conv.dilation, conv.padding, conv.stride)
+    return _add_bias(sums, conv)
+
+def bitplane_conv1d(conv, x):
+    # Same result as conv(x) for an nn.Conv1d with ternary weights and zero padding
+    sums = _bitplane_conv(x.unsqueeze(-1), conv.weight.unsqueeze(-1), conv.kernel_size + (1,), conv.dilation + (1,),
+                          conv.padding + (0,), conv.stride + (1,))
+    return _add_bias(sums[..., 0], conv)
+
+def bitplane_linear(linear, x):
+    # Same result as linear(x) for an nn.Linear with ternary weights
+    return _add_bias(ternary_matmul(_to_trits(x), _to_trits(linear.weight)), linear)
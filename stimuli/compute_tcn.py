@@ -31,15 +31,36 @@ import numpy as np
 import torch
 import torch.nn as nn
 
-np.random.seed(69)
-torch.manual_seed(42)
+numpy_seed = 69
+torch_seed = 42
+
+np.random.seed(numpy_seed)
+torch.manual_seed(torch_seed)
+
+# torch.inference_mode is only available from torch 1.9 on
+inference_mode = getattr(torch, 'inference_mode', torch.no_grad)
 
 import numpy as np
 import matplotlib.pyplot as plt
 from collections import namedtuple, OrderedDict
 from tqdm import tqdm
+import argparse
+import itertools
+import copy
+import json
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
 
 from utils import *
+from bitplane_engine import bitplane_conv1d, bitplane_conv2d, bitplane_linear
+from stimuli_bundle import gen_readmemb_meta, gen_intf_meta, gen_values_meta, open_array, save_bundle, load_bundle, export_artifacts, bundle_name
+from stimuli_cache import cache_key, cache_lookup, cache_store, link_file, cache_name, cache_size
 
 import gen_activationmemory_full_stimuli as actmemory
 import gen_weightmemory_full_stimuli as weightmemory
@@ -198,8 +219,14 @@ thresholds_widths = _thresholds(pos=ocu.inputwidths.thresh_pos,
                                 neg=ocu.inputwidths.thresh_neg,
                                 we=ocu.inputwidths.threshold_store_to_fifo)
 
+_actmem_words = namedtuple("_actmem_words", "encoded")
+actmem_words_types = _actmem_words(encoded='unsigned')
+actmem_words_widths = _actmem_words(encoded=(1, (physicalbitsperword)))
+
 Thresholds = namedtuple('Thresholds', 'lo hi')
 
+_weight_schedule = namedtuple('_weight_schedule', 'addr bank layer')
+
 cyclenum = 0
 
 pipelinedelay = 1
@@ -207,12 +234,7 @@ widthcounter = 0
 heightcounter = 0
 counting = 1
 
-codebook, origcodebook = gen_codebook()
-reverse_codebook = {}
-
-for x, y in codebook.items():
-    if y not in reverse_codebook:
-        reverse_codebook[y] = x
+encoding_table, decoding_table = load_codebook_tables()
 
 def format_output(output):
     string = ''
@@ -242,25 +264,32 @@ def get_thresholds(conv_node, bn_node):
     thresh_high = torch.where(torch.eq(thresh_high, -0.), torch.zeros_like(thresh_high), thresh_high)
     return Thresholds(thresh_low, thresh_high)
 
-def double_threshold(x, xmin, xmax):
-    if x.ndim == 4:
-        xmin = xmin.unsqueeze(-1).unsqueeze(-1)
-        xmax = xmax.unsqueeze(-1).unsqueeze(-1)
-    elif x.ndim == 3:
-        xmax = xmax.unsqueeze(-1)
-        xmin = xmin.unsqueeze(-1)
-
-    max_t = torch.gt(x, xmax)
-    min_t = torch.gt(-x, -xmin) * (-1)
+def int_thresholds(thresh, ndim):
+    # Integer thresholds of a layer, shaped to broadcast against (batch, channels, ...) activations
+    shape = (1, -1) + (1,) * (ndim - 2)
+    return Thresholds(thresh.lo.detach().to(torch.int64).reshape(shape), thresh.hi.detach().to(torch.int64).reshape(shape))
 
-    return (max_t + min_t).float()
+def double_threshold_into(x, thresh, out, mask):
+    # Writes the ternary thresholding of x into the int8 tensor out, mask is a bool tensor of the same shape.
+    # hi >= lo holds for every channel, so values below lo are never above hi.
+    torch.gt(x, thresh.hi, out=mask)
+    out.copy_(mask)
+    torch.lt(x, thresh.lo, out=mask)
+    return out.masked_fill_(mask, -1)
 
 class DensetoConv(nn.Module):
-    def __init__(self, input_shape, n_classes):
+    def __init__(self, input_shape, n_classes, verify=False):
         self.n_classes = n_classes
         self.input_shape = input_shape
         self.n_inputs = int(np.prod(list(input_shape[1:])))
         self.conv_channels = int(np.ceil((self.n_inputs // (k ** 2)) / (ni // weight_stagger)) * ni // weight_stagger)
+        self.verify = verify
+
+        # Position of every flat input in the flattened (conv_channels, k, k) conv input
+        n_pixels = self.input_shape[2] * self.input_shape[3]
+        inputs = np.arange(self.n_inputs)
+        self.conv_index = torch.as_tensor((inputs // n_pixels) * k * k + ((inputs % n_pixels) // k) * k + (inputs % n_pixels) % k)
+
         with torch.no_grad():
             super(DensetoConv, self).__init__()
             self.dense = nn.Linear(self.n_inputs, out_features=n_classes)
@@ -274,48 +303,53 @@ class DensetoConv(nn.Module):
             self.conv.weight.copy_(self.weights_to_conv(weights=self.dense.weight))
             self.conv.weight.requires_grad = False
 
-    def acts_to_conv(self, acts):
-        conv_acts = torch.zeros(1, self.conv_channels, k, k)
+            # Check the conv mapping once with a fixed generator, so the global seed is not touched
+            acts = torch.randint(-1, 2, (1, self.n_inputs), generator=torch.Generator().manual_seed(0)).float()
+            self.check(acts)
 
-        print('acts', acts.shape, 'reshaped to', conv_acts.shape)
-        for i in range(acts.shape[1]):
-            n_pixels = self.input_shape[2] * self.input_shape[3]
-            x = (i % n_pixels) % k
-            y = (i % n_pixels) // k
-            c = i // (n_pixels)
-            conv_acts[0][c][y][x] = acts[0][i]
-        return conv_acts
+    def acts_to_conv(self, acts):
+        conv_acts = torch.zeros(acts.shape[0], self.conv_channels * k * k, dtype=acts.dtype)
+        conv_acts[:, self.conv_index] = acts
+        return conv_acts.reshape(acts.shape[0], self.conv_channels, k, k)
 
     def weights_to_conv(self, weights):
-        conv_weights = torch.zeros(self.n_classes, self.conv_channels, k, k)
-
-        print('weights', weights.shape, 'reshaped to', conv_weights.shape)
-        for o in range(self.n_classes):
-            for i in range(weights.shape[1]):
-                n_pixels = self.input_shape[2] * self.input_shape[3]
-                x = (i % n_pixels) % k
-                y = (i % n_pixels) // k
-                c = i // (n_pixels)
-                conv_weights[o][c][y][x] = weights[o][i]
-        return conv_weights
+        conv_weights = torch.zeros(self.n_classes, self.conv_channels * k * k)
+        conv_weights[:, self.conv_index] = weights
+        return conv_weights.reshape(self.n_classes, self.conv_channels, k, k)
 
-    def forward(self, x):
+    def check(self, x):
         y = self.conv(self.acts_to_conv(x))
-        x = self.dense(x)
-        assert torch.equal(y.squeeze(), x.squeeze())
-        return x
+        assert torch.equal(y.flatten(start_dim=1), self.dense(x))
+
+    def forward(self, x):
+        if self.verify:
+            self.check(x)
+        return self.dense(x)
 
 class Net(nn.Module):
     def __init__(self, num_cnn_layers, num_tcn_layers, layer_no, layer_ni, n_classes, layer_k, strideh, stridew,
                  layer_padding, pooling_enable, pooling_type, pooling_kernel, pooling_padding_type, tcn_k, tcn_dilation,
-                 tcn_width, imagewidth, imageheight):
+                 tcn_width, imagewidth, imageheight, engine='float', tcn_mode='window', num_dense_layers=0):
         super(Net, self).__init__()
+        # 'float' runs the torch layers, 'bitplane' the integer engine of bitplane_engine.py
+        assert engine in ('float', 'bitplane')
+        self.engine = engine
+        # Every mode recomputes the last tcn_width steps for every frame like the accelerator does,
+        # the window pads every layer at its left edge. 'window' shifts the frames through the window,
+        # 'stream' keeps them in a ring buffer, 'sequence' unfolds all windows of a batch and runs
+        # every TCN layer once over all of them.
+        assert tcn_mode in ('window', 'stream', 'sequence')
+        self.tcn_mode = tcn_mode
         self.cnns = nn.ModuleList()
         self.tcns = nn.ModuleList()
         self.dense = None
         self.tcn_sequence = None
+        self.tcn_input = None
         self.cnn_thresh = []
         self.tcn_thresh = []
+        self.cnn_int_thresh = []
+        self.tcn_int_thresh = []
+        self.threshold_buffers = {}
 
         # CNN Layers
         for i in range(num_cnn_layers):
@@ -347,6 +381,7 @@ class Net(nn.Module):
                 conv.weight[bn.weight < 0] *= -1
                 # get thresholds of layer
                 self.cnn_thresh.append(get_thresholds(conv_node=conv, bn_node=bn))
+                self.cnn_int_thresh.append(int_thresholds(self.cnn_thresh[-1], ndim=4))
                 # zero bias of conv again, because bias is now integrated into threshold
                 conv.bias.copy_(torch.zeros_like(conv.bias))
                 self.cnns.append(nn.Sequential(OrderedDict([('conv', conv), ('bn', bn), ('pool', pool)])))
@@ -377,6 +412,7 @@ class Net(nn.Module):
                 conv.weight[bn.weight < 0] *= -1
                 # get thresholds of layer
                 self.tcn_thresh.append(get_thresholds(conv_node=conv, bn_node=bn))
+                self.tcn_int_thresh.append(int_thresholds(self.tcn_thresh[-1], ndim=3))
                 # zero bias of conv again, because bias is now integrated into threshold
                 conv.bias.copy_(torch.zeros_like(conv.bias))
                 self.tcns.append(nn.Sequential(OrderedDict([('pad', padding), ('conv', conv), ('bn', bn)])))
@@ -390,56 +426,163 @@ class Net(nn.Module):
                 x = i(x)
             self.dense = DensetoConv(x.shape, n_classes)
 
+        self.reset()
+
         print(self)
 
     def forward(self, x):
         shapes = [x.shape]
 
         # CNN forward
-        for cnn, thresh in zip(self.cnns, self.cnn_thresh):
+        for i, (cnn, thresh) in enumerate(zip(self.cnns, self.cnn_int_thresh)):
             # I am abusing batch size as tcn_width
-            x = cnn.conv(x)
+            x = self.run_conv(cnn.conv, x)
             x = cnn.pool(x)
-            x = double_threshold(x, xmin=thresh.lo, xmax=thresh.hi)
+            x = self.threshold(('cnn', i), x, thresh)
             shapes.append(x.shape)
 
         # TCN forward
         if self.tcns:
-            # input shape to TCN is (1, channels, width, height)
-            # -> reshape it to (channels)
-
-            x = torch.flatten(x, start_dim=1).squeeze()
-            self.tcn_sequence[:,:,:-1] = self.tcn_sequence[:,:,1:].clone()
-            self.tcn_sequence[:,:,-1] = x
-            x = self.tcn_sequence
-            shapes[-1] = x.shape
-            for tcn, thresh in zip(self.tcns, self.tcn_thresh):
-                x = tcn.pad(x)
-                x = tcn.conv(x)
-                x = double_threshold(x, xmin=thresh.lo, xmax=thresh.hi)
-                shapes.append(x.shape)
+            # input shape to TCN is (batch, channels, width, height)
+            # -> every image of the batch is one time step of (channels), fed in order
+            self.tcn_input = torch.flatten(x, start_dim=1).float()
+            if self.tcn_mode == 'sequence':
+                x, tcn_shapes = self.tcn_sequence_forward(self.tcn_input)
+            else:
+                steps = []
+                for step in self.tcn_input:
+                    if self.tcn_mode == 'stream':
+                        x, tcn_shapes = self.tcn_stream_step(step)
+                    else:
+                        x, tcn_shapes = self.tcn_window_step(step)
+                    steps.append(x.clone())
+                x = torch.cat(steps)
+            shapes = shapes[:-1] + tcn_shapes
 
         # Dense forward
         if self.dense:
             x = torch.flatten(x, start_dim=1)
             shapes[-1] = x.shape
-            x = self.dense(x)
-            # x = double_threshold(x, self.dense.thresh.lo, self.dense.thresh.hi)
+            if self.engine == 'bitplane':
+                x = bitplane_linear(self.dense.dense, x)
+            else:
+                x = self.dense(x.float())
             shapes.append(x.shape)
             x = x.unsqueeze(-1)
-        return x, shapes
+        # Thresholded activations live in the reused buffers, the result is returned as a new tensor
+        return x.float(), shapes
+
+    def threshold(self, layer, x, thresh):
+        key = (layer, tuple(x.shape))
+        if key not in self.threshold_buffers:
+            self.threshold_buffers[key] = (torch.empty(x.shape, dtype=torch.int8), torch.empty(x.shape, dtype=torch.bool))
+        out, mask = self.threshold_buffers[key]
+        return double_threshold_into(x, thresh, out, mask)
+
+    def run_conv(self, conv, x):
+        if self.engine == 'float':
+            return conv(x.float())
+        if isinstance(conv, nn.Conv1d):
+            return bitplane_conv1d(conv, x)
+        return bitplane_conv2d(conv, x)
+
+    def tcn_window_forward(self, x):
+        # x is a (batch, channels, tcn_width) tensor of windows, every TCN layer pads and convolves them
+        tcn_shapes = [x.shape]
+        for i, (tcn, thresh) in enumerate(zip(self.tcns, self.tcn_int_thresh)):
+            x = tcn.pad(x)
+            x = self.run_conv(tcn.conv, x)
+            x = self.threshold(('tcn', i), x, thresh)
+            tcn_shapes.append(x.shape)
+        return x, tcn_shapes
+
+    def tcn_window_step(self, step):
+        self.tcn_sequence[:,:,:-1] = self.tcn_sequence[:,:,1:].clone()
+        self.tcn_sequence[:,:,-1] = step
+        return self.tcn_window_forward(self.tcn_sequence)
+
+    def tcn_stream_step(self, step):
+        # The window is a ring buffer, a new frame overwrites the oldest one instead of shifting all
+        # of them. The frames are gathered in time order for the TCN layers.
+        width = self.tcn_sequence.shape[-1]
+        self.tcn_sequence[:, :, self.tcn_time % width] = step
+        self.tcn_time += 1
+        return self.tcn_window_forward(self.tcn_sequence[:, :, (self.tcn_time + torch.arange(width)) % width])
+
+    def tcn_sequence_forward(self, frames):
+        # frames is a (length, channels) tensor, the window of every frame is unfolded from it after
+        # the zero frames a reset window holds. Returns the outputs of all windows in one pass.
+        width = self.tcn_sequence.shape[-1]
+        frames = torch.cat((torch.zeros((width - 1, frames.shape[1])), frames))
+        x, tcn_shapes = self.tcn_window_forward(frames.unfold(0, width, 1))
+        return x, [torch.Size((1,) + tuple(j[1:])) for j in tcn_shapes]
+
+    def tcn_history(self):
+        # Number of preceding execs the TCN output of an exec depends on
+        if not self.tcns:
+            return 0
+        return self.tcn_sequence.shape[-1] - 1
 
     def reset(self):
-        if self.tcn_sequence:
+        if self.tcn_sequence is not None:
             self.tcn_sequence = torch.zeros_like(self.tcn_sequence)
+        self.tcn_time = 0
 
 
-def make_random_image(imagewidth, imageheight, layer_ni, rounded_ni):
+def make_random_image(imagewidth, imageheight, layer_ni, rounded_ni, generator=None):
     zero_pad_image = torch.zeros((1, rounded_ni, imagewidth, imageheight))
-    actual_image = torch.randint(-1, 2, (1, layer_ni, imagewidth, imageheight), dtype=torch.float32)
+    actual_image = torch.randint(-1, 2, (1, layer_ni, imagewidth, imageheight), dtype=torch.float32, generator=generator)
     zero_pad_image[0, :layer_ni] = actual_image
     return actual_image, zero_pad_image
 
+def exec_seed(index):
+    # Every exec draws its image from its own seed, so execs can be computed in any order and process
+    return int(np.random.SeedSequence([torch_seed, index]).generate_state(1)[0])
+
+def make_exec_images(start, stop, imagewidth, imageheight, layer_ni, rounded_ni):
+    return [make_random_image(imagewidth, imageheight, layer_ni, rounded_ni, generator=torch.Generator().manual_seed(exec_seed(i)))
+            for i in range(start, stop)]
+
+def run_execs(net, start, stop, imagewidth, imageheight, layer_ni, rounded_ni, replay=True):
+    # Computes the images, results and TCN inputs of execs [start, stop). TCN layers depend on
+    # earlier execs, so these are replayed from a reset first and their outputs dropped. Without
+    # replay the results are the ones of a network that is reset before exec start.
+    first = max(0, start - net.tcn_history()) if replay else start
+    images = make_exec_images(first, stop, imagewidth, imageheight, layer_ni, rounded_ni)
+
+    net.reset()
+    with inference_mode():
+        results, _ = net(torch.cat([j[0] for j in images]))
+
+    activations = translate_image_to_actmem(torch.cat([j[1] for j in images[start - first:]]))
+    responses = translate_image_to_actmem(results[start - first:].unsqueeze(-1))
+    tcn_input = net.tcn_input[start - first:].numpy() if net.tcns else None
+    return activations, responses, tcn_input
+
+def check_tcn_mode(net, start, stop, imagewidth, imageheight, layer_ni, rounded_ni):
+    # Stream and sequence mode have to give the window mode outputs for every exec
+    window_net = copy.deepcopy(net)
+    window_net.tcn_mode = 'window'
+    first = max(0, start - window_net.tcn_history())
+    images = torch.cat([j[0] for j in make_exec_images(first, stop, imagewidth, imageheight, layer_ni, rounded_ni)])
+
+    outputs = []
+    for model in (net, window_net):
+        model.reset()
+        with inference_mode():
+            outputs.append(model(images)[0][start - first:])
+    mismatch = torch.nonzero(torch.any((outputs[0] != outputs[1]).flatten(start_dim=1), dim=1))
+    assert len(mismatch) == 0, "%s mode differs from window mode at exec %d" % (net.tcn_mode, start + mismatch[0, 0])
+
+def _init_exec_worker(net):
+    global exec_worker_net
+    # Workers already run in parallel, one thread each avoids oversubscribing the host
+    torch.set_num_threads(1)
+    exec_worker_net = net
+
+def _run_exec_worker(exec_range):
+    return run_execs(exec_worker_net, *exec_range)
+
 def make_random_tcn_sequence(net, layer_ni, rounded_ni, length):
     testsequence = np.zeros((1, rounded_ni, length, 1))
     testsequence[0,:layer_ni,:,0] = np.random.randint(-1, 2, (layer_ni, length))
@@ -458,106 +601,224 @@ def translate_weights_to_weightmem(weights):
     zero_padded_weights = np.zeros((rounded_no, rounded_ni, k1, k2))
     zero_padded_weights[:n_o, :n_i] = weights
 
-    weights = zero_padded_weights
-
-    weightmem = np.empty((int(np.prod(weights.shape) / (ni / weight_stagger)), physicalbitsperword), dtype=int)
-    weightmem_decoded = np.empty((int(np.prod(weights.shape) / (ni / weight_stagger)), effectivetritsperword*2), dtype=int)
-    weightmemlist, weightmemlist_decoded = [], []
-    for i in range(weights.shape[0]):
-        for n in range(int(weights.shape[1] / int(ni / weight_stagger))):
-            for m in range(weights.shape[3]):
-                for j in range(weights.shape[2]):
-                    word = np.empty(int(ni / weight_stagger))
-                    for q in range(int(ni / weight_stagger)):
-                        word[q] = weights[i][n * int(ni / weight_stagger) + q][j][m]
-                    _word, word_decoded = translate_ternary_sequence(word)
-                    weightmemlist_decoded.append(translate_binary_string(word_decoded))
-                    weightmemlist.append(translate_binary_string(_word))
-    weightmemarray = np.asarray(weightmemlist)
-    weightmemarray_decoded = np.asarray(weightmemlist_decoded)
-    weightmem = weightmemarray.reshape((int(np.prod(weights.shape) / (ni / weight_stagger)), physicalbitsperword))
-    return weightmem, weightmemarray_decoded
-
-def translate_image_to_actmem(image):
-    actmem = np.empty(
-        (int(np.ceil((image.shape[1]) / weight_stagger)) * image.shape[2] * image.shape[3], physicalbitsperword),
-        dtype=int)
-    actmemlist, actmemlist_decoded = [], []
-
-    for n in range(image.shape[2]):
-        for m in range(image.shape[3]):
-            for j in range(int(np.ceil((image.shape[1]) / (ni / weight_stagger)))):
-                word = np.empty(int(ni / weight_stagger))
-                for i in range(int(ni / weight_stagger)):
-                    word[i] = image[0][i + j * int((ni / weight_stagger))][n][m]
-                _word, word_decoded = translate_ternary_sequence(word)
-                actmemlist.append(translate_binary_string(_word))
-                actmemlist_decoded.append(translate_binary_string(word_decoded))
-    actmemarray = np.asarray(actmemlist)
-    actmemarray_decoded = np.asarray(actmemlist_decoded)
-    actmem = actmemarray.reshape((-1, physicalbitsperword))
-
-    return actmem, actmemarray_decoded
-
-def translate_binary_string(string):
-    ret = np.empty(len(string), dtype=int)
-    for i in range(len(string)):
-        ret[i] = string[i]
-
-    return (ret)
+    # Words are ordered by output channel, input channel group, kernel column and kernel row
+    words = zero_padded_weights.reshape(rounded_no, rounded_ni // effectivetritsperword, effectivetritsperword, k1, k2)
+    words = words.transpose(0, 1, 4, 3, 2).reshape(-1, effectivetritsperword)
+    return translate_ternary_sequences(words)
+
+def schedule_weight_writes(layer_ni, layer_no, layer_k):
+    # Address, bank and layer of every weight memory write of all layers in upload order. Layer i
+    # starts at address i * k * k * weight_stagger, every output channel fills one bank in turn.
+    addrs, banks, layers = [], [], []
+    for i, (n_i, n_o) in enumerate(zip(layer_ni, layer_no)):
+        writedepth = int(layer_k * layer_k * np.ceil(n_i / (ni / weight_stagger)))
+        counter = np.arange(writedepth * n_o)
+        banks.append((counter // writedepth) % n_o)
+        addrs.append(i * k * k * weight_stagger + (counter // (writedepth * n_o)) * writedepth + counter % writedepth)
+        layers.append(np.full(len(counter), i))
+    return _weight_schedule(addr=np.concatenate(addrs), bank=np.concatenate(banks), layer=np.concatenate(layers))
+
+def translate_image_to_actmem(images):
+    # images is a (B, C, H, W) batch, returns the encoded and decoded activation memory words of every image
+    if torch.is_tensor(images):
+        images = images.detach().numpy()
+    b, c, h, w = images.shape[:4]
+    groups = int(np.ceil(c / effectivetritsperword))
+
+    padded_images = np.zeros((b, groups * effectivetritsperword, h, w), dtype=np.int8)
+    padded_images[:, :c] = images.reshape(b, c, h, w)
+
+    # Words are ordered by row, column and input channel group
+    words = padded_images.reshape(b, groups, effectivetritsperword, h, w).transpose(0, 3, 4, 1, 2)
+    actmem, actmem_decoded = translate_ternary_sequences(words.reshape(-1, effectivetritsperword))
+
+    return actmem.reshape(b, h * w * groups, -1), actmem_decoded.reshape(b, h * w * groups, -1)
+
+def translate_ternary_sequences(seqs):
+    # seqs is a (words, ni/weight_stagger) array of trits, returns the encoded and decoded bits of every word
+    seqs = np.asarray(seqs).reshape(len(seqs), -1)
+    codes = encode_trits(seqs, encoding_table)
+    return np.unpackbits(codes, axis=-1), trits_to_bits(seqs)
 
 def translate_ternary_sequence(seq):
-    string = ''
-    _seq = np.copy(seq.reshape(-1))
-
-    for i in range(len(_seq)):
-        if (int(_seq[i]) == 1):
-            string += "01"
-        elif (int(_seq[i]) == -1):
-            string += "11"
+    encoded, decoded = translate_ternary_sequences(np.reshape(seq, (1, -1)))
+    return "".join([str(j) for j in encoded[0]]), "".join([str(j) for j in decoded[0]])
+
+### NETWORK SPECS ###
+
+pooling_types = {'max': nn.MaxPool2d, 'avg': nn.AvgPool2d}
+
+# Network of a run without a spec file, spec files only need to give the parameters that differ
+default_spec = {'num_cnn_layers': 1,
+                'num_tcn_layers': 0,
+                'num_dense_layers': 0,
+                'num_execs': 1,
+                'input_imagewidth': 32,
+                'input_imageheight': 32,
+                'layer_channels': [ni, ni],
+                'n_classes': 48,
+                'layer_stridew': [1, 1, 1, 1, 1],
+                'layer_strideh': [1, 1, 1, 1, 1],
+                'layer_k': 3,
+                'layer_padding': 1,
+                'layer_pooling_enable': [False, False, False, False, False],
+                'layer_pooling_type': ['max', 'max', 'max', 'max', 'max', 'max', 'max', 'max'],
+                'layer_pooling_padding_type': [0, 0, 0, 0, 0, 0, 0, 0],
+                'layer_pooling_kernel': [2, 2, 2, 2, 2, 2, 2, 2],
+                'layer_tcn_width': 1,
+                'layer_tcn_dilation': [1, 2, 4],
+                'layer_tcn_k': [2, 2, 2]}
+
+# Smallest valid value of every count in a network spec
+spec_minimums = {'num_cnn_layers': 0,
+                 'num_tcn_layers': 0,
+                 'num_dense_layers': 0,
+                 'num_execs': 1,
+                 'input_imagewidth': 1,
+                 'input_imageheight': 1,
+                 'n_classes': 1,
+                 'layer_k': 1,
+                 'layer_tcn_width': 1}
+
+def load_specs(filename):
+    # A JSON or YAML spec file holds one network spec or a list of them. A spec with a 'grid' of
+    # parameter lists stands for the cartesian product of these lists. Returns the complete specs.
+    with open(filename, 'r') as f:
+        if filename.endswith(('.yaml', '.yml')):
+            if yaml is None:
+                raise ImportError("PyYAML is needed to read the network spec %s" % filename)
+            specs = yaml.safe_load(f)
         else:
-            string += "00"
-
-    string_decoded = string
-    string += "0" * (10 - (len(string)%10))
-    _string = ''
-    for i in range(0, int(len(string)), 10):
-        substr = string[i:i + 10]
-        try:
-            _string += reverse_codebook[substr]
-        except:
-            import IPython; IPython.embed()
-
-    return _string, string_decoded
-
-if __name__ == '__main__':
-
-    num_cnn_layers = 1
-    num_tcn_layers = 0
-    num_dense_layers = 0
+            specs = json.load(f)
+
+    if isinstance(specs, dict):
+        specs = [specs]
+
+    networks = []
+    for spec in specs:
+        grid = spec.get('grid', {})
+        base = {j: spec[j] for j in spec if j != 'grid'}
+        for values in itertools.product(*grid.values()):
+            networks.append(dict(base, **dict(zip(grid.keys(), values))))
+
+    for spec in networks:
+        unknown = set(spec) - set(default_spec) - {'name'}
+        if unknown:
+            raise ValueError("Unknown network spec parameters in %s: %s" % (filename, ", ".join(sorted(unknown))))
+        invalid = [j for j in spec_minimums if j in spec and (isinstance(spec[j], bool) or not isinstance(spec[j], int)
+                                                               or spec[j] < spec_minimums[j])]
+        if invalid:
+            raise ValueError("Invalid network spec parameters in %s: %s" % (filename, ", ".join(
+                "%s is %r, needs an integer of at least %d" % (j, spec[j], spec_minimums[j]) for j in invalid)))
+
+    return [dict(default_spec, **spec) for spec in networks]
+
+### END NETWORK SPECS ###
+
+### GENERATION STAGES ###
+
+# The artifacts are generated in stages, every stage records a fingerprint of its inputs in the
+# bundle and is only regenerated if they changed. Stages list the artifacts and the bundle
+# array sources they produce.
+stage_artifacts = OrderedDict([('test_params', ['test_params.txt']),
+                               ('layer_params', ['layer_params.txt', 'layer_params_intf.txt']),
+                               ('weights', ['weights.txt', 'weights_intf.txt']),
+                               ('thresholds', ['thresholds.txt', 'thresholds_intf.txt']),
+                               ('execs', ['activations.txt', 'activations_intf.txt', 'responses.txt', 'responses_intf.txt', 'tcn_sequence.txt'])])
+stage_sources = {'test_params': [],
+                 'layer_params': ['layer_params'],
+                 'weights': ['weights'],
+                 'thresholds': ['thresholds'],
+                 'execs': ['activations', 'responses', 'tcn_sequence']}
+# Generator modules every stage depends on, and the ones that define the widths and types of a stage's artifacts
+common_modules = ['compute_tcn.py', 'utils.py', 'stimuli_bundle.py', 'stimuli_cache.py']
+stage_modules = {'test_params': [],
+                 'layer_params': ['gen_LUCA_stimuli.py'],
+                 'weights': ['gen_weightmemory_full_stimuli.py'],
+                 'thresholds': ['gen_ocu_pool_weights_stimuli.py'],
+                 'execs': ['gen_activationmemory_full_stimuli.py', 'bitplane_engine.py']}
+
+# Shards of the execs are written to <outdir>/shard_<index>
+shard_prefix = 'shard_'
+# Number of execs that are computed and written at once. Batches save the per-call overhead of small
+# images and amortize the TCN history every chunk replays, large images are compute bound and only
+# need more memory for larger batches.
+exec_chunksize = 128
+
+def stage_fingerprints(spec, args):
+    network = {j: spec[j] for j in spec if j != 'name'}
+    # The weights and thresholds are drawn before any image, they do not depend on the number of execs
+    structure = {j: network[j] for j in network if j != 'num_execs'}
+    seeds = [numpy_seed, torch_seed]
+    inputs = {'test_params': {'network': network},
+              'layer_params': {'structure': structure},
+              'weights': {'structure': structure, 'seeds': seeds},
+              'thresholds': {'structure': structure, 'seeds': seeds},
+              'execs': {'network': network, 'seeds': seeds, 'engine': args.engine, 'tcn_mode': args.tcn_mode}}
+    return {j: cache_key(dict(inputs[j], stage=j), common_modules + stage_modules[j]) for j in stage_artifacts}
+
+def load_stages(bundledir):
+    # Returns the arrays, artifacts and stage fingerprints of the previous bundle in bundledir
+    try:
+        arrays, meta = load_bundle(bundledir)
+    except (OSError, ValueError, KeyError):
+        return {}, {}, {}
+    return arrays, meta.get('artifacts', {}), meta.get('stages', {})
+
+### END GENERATION STAGES ###
+
+### STIMULI GENERATION ###
+
+def generate_stimuli(spec, args, outdir='.'):
+    # Every network draws its weights from the same seeds, as if it was the only one generated
+    np.random.seed(numpy_seed)
+    torch.manual_seed(torch_seed)
+    os.makedirs(outdir, exist_ok=True)
+    bundledir = os.path.join(outdir, args.bundle)
+
+    remove_shards(outdir, shard_count(args.shards, spec['num_execs']))
+
+    # Cached sets and unchanged stages skip the inference, so the checks of -vd and -vt would never run
+    verify = args.verify_dense or args.verify_tcn
+
+    if(args.cache):
+        key = cache_key({'spec': {j: spec[j] for j in spec if j != 'name'}, 'seeds': [numpy_seed, torch_seed],
+                         'engine': args.engine, 'tcn_mode': args.tcn_mode, 'text': args.text, 'shards': args.shards})
+        if(not verify and cache_lookup(args.cachedir, key, outdir, {bundle_name: bundledir})):
+            print("Using cached stimuli %s" % key)
+            return
+
+    fingerprints = stage_fingerprints(spec, args)
+    old_arrays, old_artifacts, old_stages = ({}, {}, {}) if args.force else load_stages(bundledir)
+    stale = [j for j in stage_artifacts if old_stages.get(j) != fingerprints[j] or not all(n in old_artifacts for n in stage_artifacts[j])
+             or (j == 'execs' and verify)]
+
+    num_cnn_layers = spec['num_cnn_layers']
+    num_tcn_layers = spec['num_tcn_layers']
+    num_dense_layers = spec['num_dense_layers']
     num_layers = num_cnn_layers + num_tcn_layers + num_dense_layers
-    num_execs = 1
+    num_execs = spec['num_execs']
 
-    input_imagewidth = 32
-    input_imageheight = 32
+    input_imagewidth = spec['input_imagewidth']
+    input_imageheight = spec['input_imageheight']
 
-    layer_channels = [ni, ni]
-    n_classes = 48
+    layer_channels = spec['layer_channels']
+    n_classes = spec['n_classes']
     layer_ni = layer_channels[:-1]
     layer_no = layer_channels[1:]
-    layer_stridew = [1, 1, 1, 1, 1]
-    layer_strideh = [1, 1, 1, 1, 1]
-    layer_k = 3
-    layer_padding = 1
+    layer_stridew = spec['layer_stridew']
+    layer_strideh = spec['layer_strideh']
+    layer_k = spec['layer_k']
+    layer_padding = spec['layer_padding']
 
-    layer_pooling_enable = [False, False, False, False, False]
-    layer_pooling_type = [nn.MaxPool2d, nn.MaxPool2d, nn.MaxPool2d, nn.MaxPool2d, nn.MaxPool2d, nn.MaxPool2d, nn.MaxPool2d, nn.MaxPool2d]
-    layer_pooling_padding_type = [0, 0, 0, 0, 0, 0, 0, 0]
-    layer_pooling_kernel = [2, 2, 2, 2, 2, 2, 2, 2]
+    layer_pooling_enable = spec['layer_pooling_enable']
+    layer_pooling_type = [pooling_types[j] for j in spec['layer_pooling_type']]
+    layer_pooling_padding_type = spec['layer_pooling_padding_type']
+    layer_pooling_kernel = spec['layer_pooling_kernel']
 
-    layer_tcn_width = 1
-    layer_tcn_dilation = [1, 2, 4]
-    layer_tcn_k = [2, 2, 2]
+    layer_tcn_width = spec['layer_tcn_width']
+    layer_tcn_dilation = spec['layer_tcn_dilation']
+    layer_tcn_k = spec['layer_tcn_k']
 
     assert len(layer_channels) == num_layers + 1
     assert len(layer_strideh) >= num_cnn_layers
@@ -568,35 +829,15 @@ if __name__ == '__main__':
     if num_tcn_layers == 0:
         assert layer_tcn_width == 1
 
-
     rounded_no = [int(np.ceil(n / (ni // weight_stagger)) * ni // weight_stagger) for n in layer_no]
     rounded_ni = [int(np.ceil(n / (ni // weight_stagger)) * ni // weight_stagger) for n in layer_ni]
 
-
-
     net = Net(num_cnn_layers, num_tcn_layers, layer_no, layer_ni, n_classes, layer_k, layer_strideh, layer_stridew,
               layer_padding, layer_pooling_enable, layer_pooling_type, layer_pooling_kernel, layer_pooling_padding_type,
-              layer_tcn_k, layer_tcn_dilation, layer_tcn_width, input_imagewidth, input_imageheight)
-
-    image, padded_image = make_random_image(input_imagewidth, input_imageheight, layer_ni[0], rounded_ni[0])
-
-    actmem = translate_image_to_actmem(padded_image)
-
-    weightmem_layers, weightmem_layers_decoded = [], []
-    for i in range(num_cnn_layers):
-        weightmem_layer, weightmem_layer_decoded = translate_weights_to_weightmem(net.cnns[i].conv.weight)
-        weightmem_layers.append(weightmem_layer)
-        weightmem_layers_decoded.append(weightmem_layer_decoded)
-    for i in range(num_tcn_layers):
-        weightmem_layer, weightmem_layer_decoded = translate_weights_to_weightmem(translate_tcn_weights_to_cnn_weights(net.tcns[i].conv.weight))
-        weightmem_layers.append(weightmem_layer)
-        weightmem_layers_decoded.append(weightmem_layer_decoded)
-    for i in range(num_dense_layers):
-        weightmem_layer, weightmem_layer_decoded = translate_weights_to_weightmem(net.dense.conv.weight)
-        weightmem_layers.append(weightmem_layer)
-        weightmem_layers_decoded.append(weightmem_layer_decoded)
-
-    weightmem, weightmem_decoded = np.concatenate(weightmem_layers), np.concatenate(weightmem_layers_decoded)
+              layer_tcn_k, layer_tcn_dilation, layer_tcn_width, input_imagewidth, input_imageheight, engine=args.engine,
+              tcn_mode=args.tcn_mode, num_dense_layers=num_dense_layers)
+    if net.dense:
+        net.dense.verify = args.verify_dense
 
     dummy_input = torch.zeros((1, layer_ni[0], input_imagewidth, input_imageheight))
     result, outshapes = net(dummy_input)
@@ -607,9 +848,13 @@ if __name__ == '__main__':
 
     num_responses = np.prod(outshapes[-1][-2:])*rounded_no[-1]/(no//weight_stagger)
     num_acts = np.prod(outshapes[0][-2:])*rounded_no[0]/(no//weight_stagger)
-    f_test_params = open("test_params.txt", 'w+')
-    f_test_params.write("%d,%d,%d,%d,%d,%d,%d,%d,%d,%d\n" % (num_execs, input_imagewidth, input_imageheight, rounded_ni[0], num_acts, num_responses, num_layers % 2, num_layers, num_cnn_layers, num_tcn_layers))
-    f_test_params.close()
+
+    # All artifacts are collected as arrays in a stimuli bundle, the text files are exported from it
+    bundle_arrays = OrderedDict()
+    bundle_artifacts = OrderedDict()
+
+    if 'test_params' in stale:
+        bundle_artifacts['test_params.txt'] = gen_values_meta([[num_execs, input_imagewidth, input_imageheight, rounded_ni[0], num_acts, num_responses, num_layers % 2, num_layers, num_cnn_layers, num_tcn_layers]])
 
     weightmemorywrites = 0
     threshold_writes = 0
@@ -625,175 +870,311 @@ if __name__ == '__main__':
     for i in memwrites:
         print(i)
 
-    current_weight_write_layer, current_thresh_write_layer = 0, 0
-    thresh_addr = 0
-    weightmem_counter = 0
-    weightmem_depth = np.zeros(no, dtype=int)
-    weightmem_show = np.zeros((no, ni // (ni // weight_stagger) * k * k * 8))
-
-    print("Generating layer params stimuli file...")
-    f_layer_param = open("layer_params.txt", 'w+')
-    f_layer_param_intf = open("layer_params_intf.txt", 'w+')
-    for i in range(num_layers):
-        #CNN Layers
-        if (i < num_cnn_layers):
-            b, c, h, w = outshapes[i]
-            imagewidth = h
-            imageheight = w
-            stride_height = layer_strideh[i]
-            stride_width = layer_stridew[i]
-            padding_type = layer_padding
-            is_tcn = 0
-            tcn_k = 0
-            tcn_width_mod_dil = 0
-            pooling_enable = int(layer_pooling_enable[i])
-            pooling_type = int(layer_pooling_type[i] != nn.MaxPool2d)
-            pooling_kernel = layer_pooling_kernel[i]
-            pooling_padding_type = layer_pooling_padding_type[i]
-
-        # TCN Layers
-        elif i < num_layers - num_dense_layers:
-            b, c, l = outshapes[i]
-            is_tcn = 1
-            tcn_k = layer_tcn_k[i - num_cnn_layers]
-            imagewidth = layer_tcn_dilation[i - num_cnn_layers]
-            imageheight = int(np.ceil(l / imagewidth)) + (tcn_k - 1)
-            stride_width = 1
-            stride_height = 1
-            padding_type = 1
-            pooling_enable=0
-            pooling_type=0
-            pooling_kernel=0
-            pooling_padding_type=0
-            tcn_width_mod_dil = l % imagewidth  # not dilation but modulo, because of longest path
-            tcn_1d_width = l
-
-        # Dense Layers
+    if 'layer_params' not in stale:
+        print("Skipping unchanged layer params stimuli file...")
+    else:
+        print("Generating layer params stimuli file...")
+        layer_params_list = []
+        for i in range(num_layers):
+            #CNN Layers
+            if (i < num_cnn_layers):
+                b, c, h, w = outshapes[i]
+                imagewidth = h
+                imageheight = w
+                stride_height = layer_strideh[i]
+                stride_width = layer_stridew[i]
+                padding_type = layer_padding
+                is_tcn = 0
+                tcn_k = 0
+                tcn_width_mod_dil = 0
+                pooling_enable = int(layer_pooling_enable[i])
+                pooling_type = int(layer_pooling_type[i] != nn.MaxPool2d)
+                pooling_kernel = layer_pooling_kernel[i]
+                pooling_padding_type = layer_pooling_padding_type[i]
+
+            # TCN Layers
+            elif i < num_layers - num_dense_layers:
+                b, c, l = outshapes[i]
+                is_tcn = 1
+                tcn_k = layer_tcn_k[i - num_cnn_layers]
+                imagewidth = layer_tcn_dilation[i - num_cnn_layers]
+                imageheight = int(np.ceil(l / imagewidth)) + (tcn_k - 1)
+                stride_width = 1
+                stride_height = 1
+                padding_type = 1
+                pooling_enable=0
+                pooling_type=0
+                pooling_kernel=0
+                pooling_padding_type=0
+                tcn_width_mod_dil = l % imagewidth  # not dilation but modulo, because of longest path
+                tcn_1d_width = l
+
+            # Dense Layers
+            else:
+                imagewidth = layer_k
+                imageheight = layer_k
+                stride_height = 1
+                stride_width = 1
+                padding_type = 0
+                is_tcn = 0
+                tcn_k = 0
+                tcn_width_mod_dil = 0
+                pooling_enable = 0
+                pooling_type = 0
+                pooling_kernel = 0
+                pooling_padding_type = 0
+
+            layer_params = _layer_param(imagewidth=imagewidth,
+                                        imageheight=imageheight,
+                                        k=layer_k,
+                                        ni=rounded_ni[i],
+                                        no=rounded_no[i],
+                                        stride_height=stride_height,
+                                        stride_width=stride_width,
+                                        padding_type=padding_type,
+                                        pooling_enable=pooling_enable,
+                                        pooling_pooling_type=pooling_type,
+                                        pooling_kernel=pooling_kernel,
+                                        pooling_padding_type=pooling_padding_type,
+                                        skip_in=0,
+                                        skip_out=0,
+                                        is_tcn=is_tcn,
+                                        tcn_width=layer_tcn_width,
+                                        tcn_width_mod_dil=tcn_width_mod_dil,
+                                        tcn_k=tcn_k)
+            layer_params_list.append(layer_params)
+        layer_params = _layer_param(*[np.asarray(j) for j in zip(*layer_params_list)])
+        for j in _layer_param._fields:
+            bundle_arrays['layer_params.' + j] = getattr(layer_params, j)
+        bundle_artifacts['layer_params.txt'] = gen_readmemb_meta('layer_params', layer_param_types, layer_param_widths)
+        bundle_artifacts['layer_params_intf.txt'] = gen_intf_meta('layer_params', [[j, 'd'] for j in _layer_param._fields])
+
+    if 'weights' not in stale:
+        print("Skipping unchanged weight stimuli file...")
+    else:
+        print("Generating weight stimuli file...")
+        weightmem_layers, weightmem_layers_decoded = [], []
+        for i in range(num_cnn_layers):
+            weightmem_layer, weightmem_layer_decoded = translate_weights_to_weightmem(net.cnns[i].conv.weight)
+            weightmem_layers.append(weightmem_layer)
+            weightmem_layers_decoded.append(weightmem_layer_decoded)
+        for i in range(num_tcn_layers):
+            weightmem_layer, weightmem_layer_decoded = translate_weights_to_weightmem(translate_tcn_weights_to_cnn_weights(net.tcns[i].conv.weight))
+            weightmem_layers.append(weightmem_layer)
+            weightmem_layers_decoded.append(weightmem_layer_decoded)
+        for i in range(num_dense_layers):
+            weightmem_layer, weightmem_layer_decoded = translate_weights_to_weightmem(net.dense.conv.weight)
+            weightmem_layers.append(weightmem_layer)
+            weightmem_layers_decoded.append(weightmem_layer_decoded)
+
+        weightmem, weightmem_decoded = np.concatenate(weightmem_layers), np.concatenate(weightmem_layers_decoded)
+
+        weight_schedule = schedule_weight_writes(layer_ni, layer_no, layer_k)
+        bundle_arrays['weights.addr'] = weight_schedule.addr
+        bundle_arrays['weights.bank'] = weight_schedule.bank
+        bundle_arrays['weights.wdata'] = np.packbits(weightmem[:weightmemorywrites].astype(np.uint8), axis=-1)
+        bundle_arrays['weights.decoded'] = np.packbits(weightmem_decoded[:weightmemorywrites].astype(np.uint8), axis=-1)
+        bundle_artifacts['weights.txt'] = gen_readmemb_meta('weights', weightmem_writes_types, weightmem_writes_widths,
+                                                            packed={'wdata': weightmem.shape[-1]})
+        bundle_artifacts['weights_intf.txt'] = gen_intf_meta('weights', [['addr', 'd'], ['bank', 'd'], ['decoded', 'x', weightmem_decoded.shape[-1]]])
+
+    if 'thresholds' not in stale:
+        print("Skipping unchanged thresholds stimuli file...")
+    else:
+        print("Generating thresholds stimuli file...")
+        # One threshold pair per output channel of every layer, dense layers are not thresholded
+        layer_thresholds = net.cnn_thresh + net.tcn_thresh
+        thresh_pos = np.concatenate([layer_thresholds[i].hi.detach().numpy()[:layer_no[i]] if i < len(layer_thresholds) else np.zeros(layer_no[i])
+                                     for i in range(num_layers)]).astype(np.int64)
+        thresh_neg = np.concatenate([layer_thresholds[i].lo.detach().numpy()[:layer_no[i]] if i < len(layer_thresholds) else np.zeros(layer_no[i])
+                                     for i in range(num_layers)]).astype(np.int64)
+        thresh_channels = np.concatenate([np.arange(n) for n in layer_no[:num_layers]])
+
+        thresh_bitwidth = thresholds_widths.pos[0]
+        assert np.all(thresh_pos >= thresh_neg)
+        assert np.all(thresh_neg >= -2**(thresh_bitwidth-1)) and np.all(thresh_pos < 2**(thresh_bitwidth-1)), "Thresholds exceed %d bits" % thresh_bitwidth
+
+        thresholds_save_enable = np.zeros((len(thresh_channels), no), dtype=np.uint8)
+        thresholds_save_enable[np.arange(len(thresh_channels)), thresh_channels] = 1
+        thresholds = _thresholds(pos=thresh_pos, neg=thresh_neg, we=thresholds_save_enable)
+        bundle_arrays['thresholds.pos'] = thresholds.pos
+        bundle_arrays['thresholds.neg'] = thresholds.neg
+        bundle_arrays['thresholds.we'] = np.packbits(thresholds.we, axis=-1)
+        bundle_artifacts['thresholds.txt'] = gen_readmemb_meta('thresholds', thresholds_types, thresholds_widths, packed={'we': no})
+        bundle_artifacts['thresholds_intf.txt'] = gen_intf_meta('thresholds', [['pos', 'd'], ['neg', 'd']])
+
+    if 'execs' not in stale:
+        print("Skipping unchanged activation and result stimuli file...")
+    else:
+        print("Generating activation and result stimuli file...")
+
+        # Execs are computed in chunks of at most exec_chunksize, every chunk is packed and written to the
+        # memory mapped bundle arrays before the next one, so the memory use does not depend on num_execs.
+        # Smaller chunks give every worker of --jobs some. The chunks are written in exec order, so the
+        # output does not depend on --jobs.
+        chunksize = min(exec_chunksize, int(np.ceil(num_execs / max(1, args.jobs))))
+        exec_ranges = [(start, min(start + chunksize, num_execs), input_imagewidth, input_imageheight, layer_ni[0], rounded_ni[0])
+                       for start in range(0, num_execs, chunksize)]
+        if args.jobs > 1:
+            pool = ProcessPoolExecutor(max_workers=args.jobs, initializer=_init_exec_worker, initargs=(net,))
+            exec_parts = pool.map(_run_exec_worker, exec_ranges)
         else:
-            imagewidth = layer_k
-            imageheight = layer_k
-            stride_height = 1
-            stride_width = 1
-            padding_type = 0
-            is_tcn = 0
-            tcn_k = 0
-            tcn_width_mod_dil = 0
-            pooling_enable = 0
-            pooling_type = 0
-            pooling_kernel = 0
-            pooling_padding_type = 0
-
-        layer_params = _layer_param(imagewidth=imagewidth,
-                                    imageheight=imageheight,
-                                    k=layer_k,
-                                    ni=rounded_ni[i],
-                                    no=rounded_no[i],
-                                    stride_height=stride_height,
-                                    stride_width=stride_width,
-                                    padding_type=padding_type,
-                                    pooling_enable=pooling_enable,
-                                    pooling_pooling_type=pooling_type,
-                                    pooling_kernel=pooling_kernel,
-                                    pooling_padding_type=pooling_padding_type,
-                                    skip_in=0,
-                                    skip_out=0,
-                                    is_tcn=is_tcn,
-                                    tcn_width=layer_tcn_width,
-                                    tcn_width_mod_dil=tcn_width_mod_dil,
-                                    tcn_k=tcn_k)
-        f_layer_param.write("%s \n" % format_signals(layer_params, layer_param_types, layer_param_widths))
-        f_layer_param_intf.write("%s\n" % ",".join([str(j) for j in list(layer_params)]))
-    f_layer_param.close()
-    f_layer_param_intf.close()
-
-    print("Generating weight stimuli file...")
-    f_weightmem_writes = open('weights.txt', 'w+')
-    f_weightmem_writes_intf = open('weights_intf.txt', 'w+')
-    for i in range(weightmemorywrites):
-        if i >= memwrites[current_weight_write_layer]['weight_writes']:
-            weightmem_counter = 0
-            current_weight_write_layer += 1
-            weightmem_depth[:] = current_weight_write_layer * k * k * weight_stagger
-            # weightmem_depth[:] = weightmem_depth[0]
-
-        weightmemory_writedepth = int(layer_k * layer_k * np.ceil(memwrites[current_weight_write_layer]['ni'] / (ni / weight_stagger)))
-        weightmemory_bank = (int(weightmem_counter / weightmemory_writedepth) % memwrites[current_weight_write_layer]['no'])
-        weightmemory_addr = weightmem_depth[weightmemory_bank]
-        weightmem_depth[weightmemory_bank] += 1
-        weightmemory_wdata = weightmem[i]
-        weightmem_show[weightmemory_bank, weightmemory_addr] = i  # current_weight_write_layer + 1
-        weightmem_counter += 1
-        weights = _weightmem_writes(addr=weightmemory_addr,
-                                    bank=weightmemory_bank,
-                                    wdata=weightmemory_wdata)
-        f_weightmem_writes.write("%s \n" % format_signals(weights, weightmem_writes_types, weightmem_writes_widths))
-        weight_word_string = [int("".join([str(s) for s in weightmem_decoded[i][j:j+32]]),2) for j in range(0, ni, 32)]
-        f_weightmem_writes_intf.write("%d,%d,%08x,%08x,%08x\n" % (weightmemory_addr,weightmemory_bank, *weight_word_string))
-    f_weightmem_writes.close()
-    f_weightmem_writes_intf.close()
-    # plt.matshow(weightmem_show)
-    # plt.xticks([])
-    # plt.yticks([])
-    # plt.xlabel('Address Depth')
-    # plt.ylabel('Banks')
-    # plt.show()
-
-    print("Generating thresholds stimuli file...")
-    f_thresh = open("thresholds.txt", 'w+')
-    f_thresh_intf = open("thresholds_intf.txt", 'w+')
-    for i in range(memwrites[-1]['thresh_writes']):
-        if i >= memwrites[current_thresh_write_layer]['thresh_writes']:
-            current_thresh_write_layer += 1
-            thresh_addr = 0
-        ocu_thresholds_save_enable = np.zeros(no, dtype=int)
-        ocu_thresholds_save_enable[thresh_addr] = 1
-        if (current_thresh_write_layer < num_cnn_layers):
-            ocu_thresh_pos = net.cnn_thresh[current_thresh_write_layer].hi[thresh_addr]
-            ocu_thresh_neg = net.cnn_thresh[current_thresh_write_layer].lo[thresh_addr]
-        elif current_thresh_write_layer < num_layers - num_dense_layers:
-            ocu_thresh_pos = net.tcn_thresh[current_thresh_write_layer - num_cnn_layers].hi[thresh_addr]
-            ocu_thresh_neg = net.tcn_thresh[current_thresh_write_layer - num_cnn_layers].lo[thresh_addr]
+            exec_parts = (run_execs(net, *j) for j in exec_ranges)
+
+        for exec_range, (activations, responses, tcn_frames) in zip(exec_ranges, exec_parts):
+            start = exec_range[0]
+            for name, words in (('activations', activations), ('responses', responses)):
+                write_exec_words(bundle_arrays, bundledir, name + '.encoded', words[0], start, num_execs)
+                write_exec_words(bundle_arrays, bundledir, name + '.decoded', words[1], start, num_execs)
+            # The TCN input of every exec in time order
+            if num_tcn_layers > 0:
+                encoded, _ = translate_image_to_actmem(tcn_frames.reshape(*tcn_frames.shape, 1, 1))
+                write_exec_words(bundle_arrays, bundledir, 'tcn_sequence.encoded', encoded, start, num_execs)
+            if args.verify_tcn and net.tcns and args.tcn_mode != 'window':
+                print("Checking %s mode against window mode..." % args.tcn_mode)
+                check_tcn_mode(net, *exec_range)
+        if args.jobs > 1:
+            pool.shutdown()
+
+        # Decoded words hold two bits per trit
+        for name in ('activations', 'responses'):
+            bundle_arrays[name + '.addr'] = np.tile(np.arange(len(bundle_arrays[name + '.encoded']) // num_execs), num_execs)
+            bundle_artifacts[name + '.txt'] = gen_readmemb_meta(name, actmem_words_types, actmem_words_widths,
+                                                               packed={'encoded': physicalbitsperword})
+            bundle_artifacts[name + '_intf.txt'] = gen_intf_meta(name, [['addr', 'd'], ['decoded', 'x', 2 * effectivetritsperword]])
+
+        if num_tcn_layers > 0:
+            bundle_artifacts['tcn_sequence.txt'] = gen_readmemb_meta('tcn_sequence', actmem_words_types, actmem_words_widths,
+                                                                     packed={'encoded': physicalbitsperword})
         else:
-            ocu_thresh_pos = 0
-            ocu_thresh_neg = 0
-        assert ocu_thresh_pos >= ocu_thresh_neg
-        thresh_addr += 1
-        thresholds = _thresholds(pos=ocu_thresh_pos,
-                                 neg=ocu_thresh_neg,
-                                 we=ocu_thresholds_save_enable)
-
-        f_thresh.write("%s \n" % format_signals(thresholds, thresholds_types, thresholds_widths))
-        f_thresh_intf.write("%d,%d\n" % (ocu_thresh_pos, ocu_thresh_neg))
-    f_thresh.close()
-    f_thresh_intf.close()
-
-    print("Generating activation and result stimuli file...")
-    f_activation = open("activations.txt", 'w+')
-    f_activation_intf = open("activations_intf.txt", 'w+')
-    f_responses = open("responses.txt", 'w+')
-    f_responses_intf = open("responses_intf.txt", 'w+')
-    f_tcn_sequence = open("tcn_sequence.txt", 'w+')
-    image_seq = torch.zeros((layer_tcn_width, layer_ni[0], input_imagewidth, input_imageheight))
-
-    for i in range(num_execs):
-        new_image, new_image_padded = make_random_image(input_imagewidth, input_imageheight, layer_ni[0], rounded_ni[0])
-
-        result, _ = net(new_image)
-
-        encoded_image, decoded_image = translate_image_to_actmem(new_image_padded)
-        for addr, (enc_word, dec_word) in enumerate(zip(encoded_image, decoded_image)):
-            f_activation.write("%s \n" % "".join([str(j) for j in enc_word]))
-            act_word_string = [int("".join([str(s) for s in dec_word[j:j + 32]]), 2) for j in range(0, ni, 32)]
-            f_activation_intf.write("%d,%08x,%08x,%08x\n" % (addr, *act_word_string))
-
-        encoded_result, decoded_result = translate_image_to_actmem(result.unsqueeze(-1))
-        for addr, (enc_word, dec_word) in enumerate(zip(encoded_result, decoded_result)):
-            f_responses.write("%s \n" % "".join([str(j) for j in enc_word]))
-            act_word_string = [int("".join([str(s) for s in dec_word[j:j + 32]]), 2) for j in range(0, no, 32)]
-            f_responses_intf.write("%d,%08x,%08x,%08x\n" % (addr, *act_word_string))
-
-    f_activation.close()
-    f_activation_intf.close()
-    f_responses.close()
-    f_responses_intf.close()
-    f_tcn_sequence.close()
+            bundle_artifacts['tcn_sequence.txt'] = gen_values_meta([])
+
+    # Unchanged stages keep their arrays and artifacts of the previous bundle
+    kept_sources = [source for j in stage_artifacts if j not in stale for source in stage_sources[j]]
+    kept_arrays = {j: old_arrays[j] for j in old_arrays if j.split('.')[0] in kept_sources}
+    for j in stage_artifacts:
+        if j not in stale:
+            bundle_artifacts.update((name, old_artifacts[name]) for name in stage_artifacts[j])
+    bundle_artifacts = OrderedDict((name, bundle_artifacts[name]) for j in stage_artifacts for name in stage_artifacts[j])
+
+    save_bundle(bundledir, bundle_arrays, {'artifacts': bundle_artifacts, 'stages': fingerprints}, keep=kept_arrays)
+    if(args.text):
+        # Text files of unchanged stages are only exported if they are missing
+        names = [name for j in stale for name in stage_artifacts[j]] + [name for name in bundle_artifacts if not os.path.exists(os.path.join(outdir, name))]
+        export_artifacts(outdir, dict(kept_arrays, **bundle_arrays), {'artifacts': bundle_artifacts}, names)
+
+    sharddirs = export_shards(net, dict(kept_arrays, **bundle_arrays), bundle_artifacts, fingerprints, args, outdir, num_execs,
+                              (input_imagewidth, input_imageheight, layer_ni[0], rounded_ni[0]))
+
+    if(args.cache):
+        outputs = {bundle_name: bundledir}
+        if(args.text):
+            outputs.update({j: os.path.join(outdir, j) for j in bundle_artifacts})
+        outputs.update({os.path.basename(j): j for j in sharddirs})
+        cache_store(args.cachedir, key, outputs, args.cache_size)
+
+def write_exec_words(arrays, bundledir, name, words, start, num_execs):
+    # words holds the (execs, words, bits) memory words of the execs from start on. Their packed rows
+    # are written to the bundle array name, which is created for all execs on the first chunk.
+    packed = np.packbits(words.reshape(-1, words.shape[-1]), axis=-1)
+    rows = len(packed) // len(words)
+    if name not in arrays:
+        arrays[name] = open_array(bundledir, name, packed.dtype, (num_execs * rows, packed.shape[-1]))
+    arrays[name][start * rows:start * rows + len(packed)] = packed
+
+def shard_count(shards, num_execs):
+    # An unsharded run writes no shard directories
+    return max(1, min(shards, num_execs)) if shards > 1 else 0
+
+def remove_shards(outdir, numshards):
+    # Removes the shard directories of earlier runs that are not part of this one
+    for j in os.listdir(outdir):
+        if j.startswith(shard_prefix) and j[len(shard_prefix):].isdigit() and int(j[len(shard_prefix):]) >= numshards:
+            shutil.rmtree(os.path.join(outdir, j))
+
+def export_shards(net, arrays, artifacts, fingerprints, args, outdir, num_execs, image_params):
+    # Splits the execs into self-contained directories that are simulated independently. Every
+    # shard has its own test params, activations and responses, the other text files are linked
+    # to the ones in outdir. A shard of a TCN network starts with the execs that fill the TCN
+    # history, their responses are the ones of a reset network like a new simulation sees them.
+    bounds = np.linspace(0, num_execs, shard_count(args.shards, num_execs) + 1).astype(int)
+
+    sharddirs = []
+    names = stage_artifacts['test_params'] + stage_artifacts['execs']
+    for i, (start, stop) in enumerate(zip(bounds[:-1], bounds[1:])):
+        sharddir = os.path.join(outdir, shard_prefix + "%03d" % i)
+        sharddirs.append(sharddir)
+        first = max(0, start - net.tcn_history())
+        fingerprint = cache_key({'test_params': fingerprints['test_params'], 'execs': fingerprints['execs'], 'shard': [int(first), int(start), int(stop)]})
+
+        _, _, old_stages = ({}, {}, {}) if args.force else load_stages(os.path.join(sharddir, bundle_name))
+        if(old_stages.get('shard') == fingerprint and (not args.text or all(os.path.exists(os.path.join(sharddir, j)) for j in names))):
+            print("Skipping unchanged shard %d..." % i)
+        else:
+            print("Generating shard %d..." % i)
+            # Every exec has the same number of rows in the exec arrays
+            shard_arrays = OrderedDict()
+            for name in arrays:
+                if name.split('.')[0] in stage_sources['execs']:
+                    rows = len(arrays[name]) // num_execs
+                    shard_arrays[name] = np.array(arrays[name][first * rows:stop * rows])
+
+            if first < start:
+                _, responses, _ = run_execs(net, first, start, *image_params, replay=False)
+                for field, words in zip(('encoded', 'decoded'), responses):
+                    words = np.packbits(words.reshape(-1, words.shape[-1]), axis=-1)
+                    shard_arrays['responses.' + field][:len(words)] = words
+
+            shard_artifacts = OrderedDict((j, artifacts[j]) for j in names)
+            test_params = artifacts['test_params.txt']['lines'][0]
+            shard_artifacts['test_params.txt'] = gen_values_meta([[stop - first] + test_params[1:]])
+
+            save_bundle(os.path.join(sharddir, bundle_name), shard_arrays, {'artifacts': shard_artifacts, 'stages': {'shard': fingerprint}})
+            if(args.text):
+                export_artifacts(sharddir, shard_arrays, {'artifacts': shard_artifacts})
+
+        if(args.text):
+            for j in ('layer_params', 'weights', 'thresholds'):
+                for name in stage_artifacts[j]:
+                    link_file(os.path.join(outdir, name), os.path.join(sharddir, name))
+
+    return sharddirs
+
+def _generate_network(job):
+    generate_stimuli(*job)
+
+### END STIMULI GENERATION ###
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Generates system level stimuli and expected responses")
+    parser.add_argument('-b', '--bundle', metavar='BundleDir', dest='bundle', default=bundle_name, help='Choose the directory the stimuli bundle is written to, default is '+bundle_name)
+    parser.add_argument('-vd', '--verify-dense', metavar='verifyDense', dest='verify_dense', type=str2bool, const=True, default=False, nargs='?', help='Check the conv mapping of the dense layer on every inference, default is false')
+    parser.add_argument('-e', '--engine', metavar='Engine', dest='engine', choices=['float', 'bitplane'], default='float', help='Choose the golden model engine, float runs the torch layers, bitplane the bit-exact integer bit-plane engine of the OCUs, which is slower, default is float')
+    parser.add_argument('-tm', '--tcn-mode', metavar='TCNMode', dest='tcn_mode', choices=['window', 'stream', 'sequence'], default='window', help='Choose how TCN layers are evaluated: all of them recompute the tcn_width steps of every exec like the accelerator, window shifts the frames through the window, stream keeps them in a ring buffer, sequence runs all windows of the execs in one pass, default is window')
+    parser.add_argument('-vt', '--verify-tcn', metavar='verifyTCN', dest='verify_tcn', type=str2bool, const=True, default=False, nargs='?', help='Check the stream or sequence outputs against window mode for every exec, default is false')
+    parser.add_argument('-n', '--network', metavar='NetworkSpec', dest='network', default=None, help='Choose a JSON or YAML network spec, a list of specs or a grid of parameters is generated as a sweep')
+    parser.add_argument('-o', '--output', metavar='OutputDir', dest='outdir', default='.', help='Choose the directory the stimuli are written to, sweeps write one subdirectory per network')
+    parser.add_argument('-j', '--jobs', metavar='Jobs', dest='jobs', type=int, default=1, help='Number of processes the execs, or the networks of a sweep, are computed on, the output is the same for any number, default is 1')
+    parser.add_argument('-c', '--cache', metavar='cacheEnable', dest='cache', type=str2bool, const=True, default=True, nargs='?', help='Reuse stimuli from the cache if the config, the network, the seeds, the decoder tables and the generator are unchanged, default is true')
+    parser.add_argument('-cd', '--cache-dir', metavar='CacheDir', dest='cachedir', default=cache_name, help='Choose the directory the stimuli are cached in, default is '+cache_name)
+    parser.add_argument('-cs', '--cache-size', metavar='CacheSize', dest='cache_size', type=int, default=cache_size, help='Size limit of the cache in MiB, the least recently used stimuli are evicted first, default is %d' % cache_size)
+    parser.add_argument('-s', '--shards', metavar='Shards', dest='shards', type=int, default=1, help='Split the execs into this many self-contained directories '+shard_prefix+'<index> that can be simulated in parallel, default is 1')
+    parser.add_argument('-f', '--force', metavar='forceEnable', dest='force', type=str2bool, const=True, default=False, nargs='?', help='Regenerate all stimuli, also the stages whose inputs did not change, default is false')
+    parser.add_argument('-t', '--text', metavar='textOutputEnable', dest='text', type=str2bool, const=True, default=True, nargs='?', help='Export the $readmemb text files from the stimuli bundle, default is true')
+
+    args = parser.parse_args()
+
+    if args.network is None:
+        specs = [dict(default_spec)]
+    else:
+        specs = load_specs(args.network)
+
+    if len(specs) == 1:
+        generate_stimuli(specs[0], args, args.outdir)
+    else:
+        # Sweeps run one network per worker, each into its own directory
+        outdirs = [os.path.join(args.outdir, "%03d" % i + ("_" + spec['name'] if 'name' in spec else "")) for i, spec in enumerate(specs)]
+        network_args = argparse.Namespace(**dict(vars(args), jobs=1))
+        with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+            list(pool.map(_generate_network, [(spec, network_args, outdir) for spec, outdir in zip(specs, outdirs)]))
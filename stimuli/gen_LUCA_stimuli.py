@@ -352,11 +352,8 @@ def gen_stimuli(name_stimuli, name_exp, num_vectors):
     outputs = []
     inputs = []
 
-    f = open(name_stimuli, 'w+')
-    g = open(name_exp, 'w+')
-    j_input = open(jsonIn, 'w+')
-    j_output = open(jsonOut, 'w+')
-
+    f = LineWriter(open(name_stimuli, 'w+'))
+    g = LineWriter(open(name_exp, 'w+'))
 
     for i in tqdm(range(num_vectors)):
         curr_input = realistic_test_case()
@@ -368,46 +365,44 @@ def gen_stimuli(name_stimuli, name_exp, num_vectors):
         vprint(curr_input)
         vprint(format_input(curr_input))
 
-        jprint(j_input, curr_input)
+        tprint(j_input, curr_input)
 
         vprint(curr_output)
         vprint(format_output(curr_output))
 
-        jprint(j_output, curr_output)
+        tprint(j_output, curr_output)
 
-        f.write("%s \n" % format_input(curr_input))
-        g.write("%s \n" % format_output(curr_output))
+        f.write_line(format_input(curr_input))
+        g.write_line(format_output(curr_output))
 
     f.close()
     g.close()
-    j_input.close()
-    j_output.close()
 
 def parse_stimuli(name_stimuli, name_exp, num_vectors):
 
     outputs = []
     inputs = []
 
-    f = open(name_stimuli, 'r')
-    g = open(name_exp, 'w+')
+    stimuli = parse_stimuli_file(name_stimuli, inputtypes, inputwidths)
+    g = LineWriter(open(name_exp, 'w+'))
 
-    for i in tqdm(range(num_vectors)):
-        curr_input = parse_input(f)
+    # Every cycle of the file is replayed, -num only applies to the generation
+    for i in tqdm(range(num_cycles(stimuli))):
+        curr_input = select_cycle(stimuli, i)
         curr_output = tick(curr_input)
 
         vprint(curr_input)
         vprint(format_input(curr_input))
 
-        jprint(j_input, curr_input)
+        tprint(j_input, curr_input)
 
         vprint(curr_output)
         vprint(format_output(curr_output))
 
-        jprint(j_output, curr_output)
+        tprint(j_output, curr_output)
 
-        g.write("%s \n" % format_output(curr_output))
+        g.write_line(format_output(curr_output))
 
-    f.close()
     g.close()
 
 ### END STIMULI GENERATION FUNCTION ###
@@ -418,9 +413,9 @@ if __name__=='__main__':
 
     parser = argparse.ArgumentParser(description="Stimuli generator for")
     parser.add_argument('-v', '--verbose', metavar='verbosity', dest='verbosity',  type=str2bool, const=True, default=False, nargs='?', help='Enable command line output')
-    parser.add_argument('-j', '--json', metavar='jsonOutputEnable', dest='json',  type=str2bool, const=True, default=True, nargs='?', help='Enable JSON output')
-    parser.add_argument('-jIn', '--jsonInputFile', metavar='jsonInputFile', dest='jIn',  default=str(filename)+'_json_in.txt', help='Choose your own JSON input destination file')
-    parser.add_argument('-jOut', '--jsonOutputFile', metavar='jsonOutputFile', dest='jOut',  default=str(filename)+'_json_out.txt', help='Choose your own JSON output destination file')
+    parser.add_argument('-j', '--json', metavar='jsonOutputEnable', dest='json',  type=str2bool, const=True, default=True, nargs='?', help='Enable trace output')
+    parser.add_argument('-jIn', '--jsonInputFile', metavar='jsonInputFile', dest='jIn',  default=str(filename)+'_trace_in', help='Choose your own input trace destination directory')
+    parser.add_argument('-jOut', '--jsonOutputFile', metavar='jsonOutputFile', dest='jOut',  default=str(filename)+'_trace_out', help='Choose your own output trace destination directory')
     parser.add_argument('-i', '--input', metavar='inputGeneration', dest='input',  type=str2bool, const=True, default=False, nargs='?', help='Set whether to read inputs from stimuli file or generate randomly. Default is false, meaning stimuli are generated, not read')
     parser.add_argument('-s', '--stimuli', metavar='StimuliFile', dest='stimulifile',  default=str(filename)+'_stimuli.txt', help='Choose your own stimuli output file, default is ocu_pool_weights_stimuli.txt')
     parser.add_argument('-o', '--output', metavar='OutputFile', dest='outputfile', default=str(filename)+'_exp_responses.txt', help='Choose your own expected responses output file destination, default is ocu_pool_weights_exp_responses.txt')
@@ -445,21 +440,23 @@ if __name__=='__main__':
     jsonOut = args.jOut
 
     if(args.json == True):
-        j_input = open(jsonIn, 'w+')
-        j_output = open(jsonOut, 'w+')
+        j_input = TraceWriter(jsonIn)
+        j_output = TraceWriter(jsonOut)
     else:
-        j_input = open(jsonIn, 'r')
-        j_output = open(jsonOut, 'r')
+        j_input = None
+        j_output = None
 
     config_module_state()
+    config_utils_state(args, inputtypes, inputwidths, outputtypes, outputwidths)
 
     if(args.input == False):
         gen_stimuli(args.stimulifile,args.outputfile,numvec)
     else:
         parse_stimuli(args.stimulifile,args.outputfile,numvec)
 
-    j_input.close()
-    j_output.close()
+    if(args.json == True):
+        j_input.close()
+        j_output.close()
 
 
 ### END PROGRAM ENTRY POINT ###
@@ -41,7 +41,7 @@ filename = "activationmemory_full"
 
 ### GLOBAL CONFIG ###
 
-codebook = {}
+decoding_table = None
 
 ### END GLOBAL CONFIG ###
 
@@ -67,7 +67,7 @@ bankaddressdepth = int(np.ceil(np.log2(bankdepth)))
 leftshiftbitwidth = int(np.ceil(np.log2(numbanks)))
 splitbitwidth = int(np.ceil(np.log2(weight_stagger)))+1
 
-weightmem = np.empty((numactmemsets, numbanks, bankdepth), dtype='object')
+weightmem = np.zeros((numactmemsets, numbanks, bankdepth, numdecoders), dtype=np.uint8)
 
 prev_addr = np.zeros(numbanks,dtype=int)
 prev_trits = 2*np.ones((numbanks, int(ni/weight_stagger)),dtype=int)
@@ -144,7 +144,7 @@ def config_module_state():
     leftshiftbitwidth = int(np.ceil(np.log2(numbanks)))
     splitbitwidth = int(np.ceil(np.log2(weight_stagger)))+1
 
-    weightmem = np.empty((numactmemsets, numbanks, bankdepth), dtype='object')
+    weightmem = np.zeros((numactmemsets, numbanks, bankdepth, numdecoders), dtype=np.uint8)
 
     prev_addr = np.zeros(numbanks)
     prev_trits = 2*np.ones((numbanks, int(ni/weight_stagger)),dtype=int)
@@ -172,8 +172,6 @@ def tick(inputs):
 
     _ready = []
     _collisions = []
-    _strings = []
-
     _read_enable = []
 
     if(inputs.external_req == 1):
@@ -197,7 +195,7 @@ def tick(inputs):
         write_addr[bank] = addr
 
         wdata = np.zeros((numbanks,numdecoders,8),dtype=int)
-        wdata[bank] = inputs.external_wdata
+        wdata[bank] = np.reshape(inputs.external_wdata, (numdecoders,8))
 
         left_shift = bank
 
@@ -220,12 +218,20 @@ def tick(inputs):
         left_shift = inputs.left_shift
         scatter_coefficient = inputs.scatter_coefficient
 
-    ret_weights_encoded = "0"*physicalbitsperword
+    ret_weights_encoded = np.zeros(numdecoders, dtype=np.uint8)
+    wdata_packed = np.packbits(np.asarray(wdata, dtype=np.uint8), axis=-1).reshape(numbanks, numdecoders)
 
-    for n in range(numbanks):
+    # Decode the words of all banks that were read in the last cycle at once
+    trits = 2*np.ones((numbanks, effectivetritsperword), dtype=int)
+    read_banks = np.flatnonzero(np.asarray(prev_ready) == 1)
+
+    if(len(read_banks) > 0):
+        words = weightmem[prev_read_bank, read_banks, np.asarray(prev_addr, dtype=int)[read_banks]]
+        trits[read_banks] = decode_codes(words, decoding_table)[:, :effectivetritsperword]
+        if(prev_left_shift in read_banks):
+            ret_weights_encoded = weightmem[prev_read_bank, prev_left_shift, int(prev_addr[prev_left_shift])].copy()
 
-        codes = []
-        content = []
+    for n in range(numbanks):
 
         if(read_enable_bank_set == write_enable_bank_set and read_enable[n] == 1 and write_enable[n] == 1):
             rw_collision_ = 1;
@@ -236,61 +242,17 @@ def tick(inputs):
             write_enable_ = write_enable[n];
             rw_collision_ = 0;
 
-        if (prev_ready[n] == 1):
-            weights_encoded = weightmem[prev_read_bank][n][int(prev_addr[n])]
-            if(prev_left_shift == n):
-                ret_weights_encoded = weights_encoded
-            _weights_encoded = str(weights_encoded)
-            string = ''
-
-            for i in range(0,len(_weights_encoded),8):
-                string += _weights_encoded[i:i+8]
-                codes.append(string)
-                #print("Enc:")
-                #print(string)
-                string =''
-
-            for i in codes:
-                content.append(decode(i))
-
-            string = ''
-            for i in content:
-                string += i
-
-            string = string[:effectivetritsperword*2]
-
-        else:
-            string = ''
-            for i in range(effectivetritsperword):
-                string += 'XX'
-
         if(write_enable_ == 1):
-            st = ''
-            for j in range(numdecoders):
-                for i in range(8):
-                    st += str(wdata[n][j][i])
-
-            weightmem[write_enable_bank_set][n][write_addr[n]] = st
+            weightmem[write_enable_bank_set, n, int(write_addr[n])] = wdata_packed[n]
 
         ready_ = ~rw_collision_ & read_enable_
 
         _read_enable.append(read_enable_)
         _ready.append(ready_)
         _collisions.append(rw_collision_)
-        _strings.append(string)
 
     # Next state calculation
-    ___strings = []
-    __strings = (np.asarray(_strings)).reshape(numbanks,-1)
-    for i in range(__strings.shape[0]):
-        ___strings.append(__strings[(i+prev_left_shift+numbanks)%numbanks])
-
-    array = []
-    for string in ___strings:
-        for x in range(0,len(*string),2):
-            array.append(parse_ternary(string[0][x:x+2]))
-    trits = np.asarray(array)
-    trits = trits.reshape(k,ni)
+    trits = np.roll(trits, -prev_left_shift, axis=0).reshape(k,ni)
 
     scatter_view = trits.reshape(int(k*weight_stagger),int(ni/weight_stagger))
     output_view = np.zeros((int(k*weight_stagger),int(ni/weight_stagger)),dtype=int)
@@ -305,15 +267,7 @@ def tick(inputs):
 
     #ACQUISITION
 
-    encoded = np.empty(physicalbitsperword,dtype=int)
-
-    for i in range(len(str(ret_weights_encoded)[:physicalbitsperword])):
-        if (str(ret_weights_encoded)[:physicalbitsperword][i] == '1'):
-            encoded[i] = 1
-        else:
-            encoded[i] = 0
-
-    external_act = encoded
+    external_act = np.unpackbits(ret_weights_encoded).astype(int)
 
     if(prev_command_source == 1):
         external_valid = (prev_external_we+1)%2
@@ -395,7 +349,7 @@ def write_mem_rand(addr,bank,membank):
     external_we = 0
     external_req = 0
     external_addr = 0
-    external_wdata = 0
+    external_wdata = np.zeros((numdecoders,8), dtype=int)
 
     read_enable = np.zeros(numbanks, dtype=int)
     read_enable_bank_set = (membank+1)%numactmemsets
@@ -493,14 +447,8 @@ def gen_stimuli(name_stimuli, name_exp, num_vectors):
     outputs = []
     inputs = []
 
-    f = open(name_stimuli, 'w+')
-    g = open(name_exp, 'w+')
-    if(args.json == True):
-        j_input = open(jsonIn, 'w+')
-        j_output = open(jsonOut, 'w+')
-    else:
-        j_input = open(jsonIn, 'r')
-        j_output = open(jsonOut, 'r')
+    f = LineWriter(open(name_stimuli, 'w+'))
+    g = LineWriter(open(name_exp, 'w+'))
 
     for m in range(numactmemsets):
         for n in range(numbanks):
@@ -514,13 +462,13 @@ def gen_stimuli(name_stimuli, name_exp, num_vectors):
                 vprint(curr_input)
                 vprint(format_input(curr_input))
 
-                #jprint(j_input, curr_input)
+                #tprint(j_input, curr_input)
 
                 vprint(curr_output)
                 vprint(format_output(curr_output))
 
-                f.write("%s \n" % format_input(curr_input))
-                g.write("%s \n" % format_output(curr_output))
+                f.write_line(format_input(curr_input))
+                g.write_line(format_output(curr_output))
 
     for i in tqdm(range(num_vectors)):
         curr_input = rand_test_case()
@@ -532,47 +480,44 @@ def gen_stimuli(name_stimuli, name_exp, num_vectors):
         vprint(curr_input)
         vprint(format_input(curr_input))
 
-        jprint(j_input, curr_input)
+        tprint(j_input, curr_input)
 
         vprint(curr_output)
         vprint(format_output(curr_output))
 
-        jprint(j_output, curr_output)
+        tprint(j_output, curr_output)
 
-        f.write("%s \n" % format_input(curr_input))
-        g.write("%s \n" % format_output(curr_output))
+        f.write_line(format_input(curr_input))
+        g.write_line(format_output(curr_output))
 
     f.close()
     g.close()
 
-    j_input.close()
-    j_output.close()
-
 def parse_stimuli(name_stimuli, name_exp, num_vectors):
 
     outputs = []
     inputs = []
 
-    f = open(name_stimuli, 'r')
-    g = open(name_exp, 'w+')
+    stimuli = parse_stimuli_file(name_stimuli, inputtypes, inputwidths)
+    g = LineWriter(open(name_exp, 'w+'))
 
-    for i in tqdm(range(num_vectors)):
-        curr_input = parse_input(f)
+    # Every cycle of the file is replayed, including the memory writes before the num_vectors test cases
+    for i in tqdm(range(num_cycles(stimuli))):
+        curr_input = select_cycle(stimuli, i)
         curr_output = tick(curr_input)
 
         vprint(curr_input)
         vprint(format_input(curr_input))
 
-        jprint(j_input, curr_input)
+        tprint(j_input, curr_input)
 
         vprint(curr_output)
         vprint(format_output(curr_output))
 
-        jprint(j_output, curr_output)
+        tprint(j_output, curr_output)
 
-        g.write("%s \n" % format_output(curr_output))
+        g.write_line(format_output(curr_output))
 
-    f.close()
     g.close()
 
 ### END STIMULI GENERATION FUNCTION ###
@@ -582,9 +527,9 @@ if __name__=='__main__':
 
     parser = argparse.ArgumentParser(description="Stimuli generator for")
     parser.add_argument('-v', '--verbose', metavar='verbosity', dest='verbosity',  type=str2bool, const=True, default=False, nargs='?', help='Enable command line output')
-    parser.add_argument('-j', '--json', metavar='jsonOutputEnable', dest='json',  type=str2bool, const=True, default=True, nargs='?', help='Enable JSON output')
-    parser.add_argument('-jIn', '--jsonInputFile', metavar='jsonInputFile', dest='jIn',  default=str(filename)+'_json_in.txt', help='Choose your own JSON input destination file')
-    parser.add_argument('-jOut', '--jsonOutputFile', metavar='jsonOutputFile', dest='jOut',  default=str(filename)+'_json_out.txt', help='Choose your own JSON output destination file')
+    parser.add_argument('-j', '--json', metavar='jsonOutputEnable', dest='json',  type=str2bool, const=True, default=True, nargs='?', help='Enable trace output')
+    parser.add_argument('-jIn', '--jsonInputFile', metavar='jsonInputFile', dest='jIn',  default=str(filename)+'_trace_in', help='Choose your own input trace destination directory')
+    parser.add_argument('-jOut', '--jsonOutputFile', metavar='jsonOutputFile', dest='jOut',  default=str(filename)+'_trace_out', help='Choose your own output trace destination directory')
     parser.add_argument('-i', '--input', metavar='inputGeneration', dest='input',  type=str2bool, const=True, default=False, nargs='?', help='Set whether to read inputs from stimuli file or generate randomly. Default is false, meaning stimuli are generated, not read')
     parser.add_argument('-s', '--stimuli', metavar='StimuliFile', dest='stimulifile',  default=str(filename)+'_stimuli.txt', help='Choose your own stimuli output file, default is ocu_pool_weights_stimuli.txt')
     parser.add_argument('-o', '--output', metavar='OutputFile', dest='outputfile', default=str(filename)+'_exp_responses.txt', help='Choose your own expected responses output file destination, default is ocu_pool_weights_exp_responses.txt')
@@ -613,22 +558,24 @@ if __name__=='__main__':
     jsonOut = args.jOut
 
     config_module_state()
-    codebook, orig_codebook = gen_codebook()
+    config_utils_state(args, inputtypes, inputwidths, outputtypes, outputwidths)
+    encoding_table, decoding_table = load_codebook_tables()
 
     if(args.json == True):
-        j_input = open(jsonIn, 'w+')
-        j_output = open(jsonOut, 'w+')
+        j_input = TraceWriter(jsonIn)
+        j_output = TraceWriter(jsonOut)
     else:
-        j_input = open(jsonIn, 'r')
-        j_output = open(jsonOut, 'r')
+        j_input = None
+        j_output = None
 
     if(args.input == False):
         gen_stimuli(args.stimulifile,args.outputfile,numvec)
     else:
         parse_stimuli(args.stimulifile,args.outputfile,numvec)
 
-    j_input.close()
-    j_output.close()
+    if(args.json == True):
+        j_input.close()
+        j_output.close()
 
 
 ### END PROGRAM ENTRY POINT ###
@@ -41,7 +41,7 @@ filename = "weightmemory_full"
 
 ### GLOBAL CONFIG ###
 
-codebook = {}
+decoding_table = None
 
 ### END GLOBAL CONFIG ###
 
@@ -68,7 +68,7 @@ bankaddressdepth = int(np.ceil(np.log2(bankdepth)))
 leftshiftbitwidth = int(np.ceil(np.log2(numbanks)))
 splitbitwidth = int(np.ceil(np.log2(weight_stagger)))+1
 
-weightmem = np.empty((bankdepth), dtype='object')
+weightmem = np.zeros((bankdepth, numdecoders), dtype=np.uint8)
 
 prev_addr = np.zeros(numbanks)
 prev_trits = 2*np.ones((numbanks, int(ni/weight_stagger)),dtype=int)
@@ -142,7 +142,7 @@ def config_module_state():
     leftshiftbitwidth = int(np.ceil(np.log2(numbanks)))
     splitbitwidth = int(np.ceil(np.log2(weight_stagger)))+1
 
-    weightmem = np.empty((bankdepth), dtype='object')
+    weightmem = np.zeros((bankdepth, numdecoders), dtype=np.uint8)
 
     prev_addr = np.zeros(numbanks)
     prev_trits = 2*np.ones((numbanks, int(ni/weight_stagger)),dtype=int)
@@ -171,8 +171,6 @@ def tick(inputs):
 
     _ready = []
     _collisions = []
-    _strings = []
-
     _read_enable = []
 
 
@@ -194,7 +192,7 @@ def tick(inputs):
         write_addr[bank] = addr
 
         wdata = np.zeros((numbanks,numdecoders,8),dtype=int)
-        wdata[bank] = inputs.external_wdata
+        wdata[bank] = np.reshape(inputs.external_wdata, (numdecoders,8))
 
     else:
         command_source = 0
@@ -202,18 +200,20 @@ def tick(inputs):
         read_enable = inputs.read_enable
         write_enable = inputs.write_enable
 
-        read_addr = inputs.read_addr
-        write_addr = inputs.write_addr
+        # A single bank is parsed back from a stimuli file as a scalar address
+        read_addr = np.atleast_1d(inputs.read_addr)
+        write_addr = np.atleast_1d(inputs.write_addr)
 
         wdata = inputs.wdata
 
 
-    ret_weights_encoded = '0'*physicalbitsperword
+    ret_weights_encoded = np.zeros(numdecoders, dtype=np.uint8)
+    wdata_packed = np.packbits(np.asarray(wdata, dtype=np.uint8), axis=-1).reshape(numbanks, numdecoders)
 
-    for n in range(numbanks):
+    # Words are read in bank order, before the write of their bank, and decoded all at once afterwards
+    words = np.zeros((numbanks, numdecoders), dtype=np.uint8)
 
-        codes = []
-        content = []
+    for n in range(numbanks):
 
         if(read_enable == 1 and write_enable == 1):
             rw_collision_ = 1;
@@ -225,75 +225,32 @@ def tick(inputs):
             rw_collision_ = 0;
 
         if (prev_ready == 1):
-            weights_encoded = weightmem[prev_addr]
-            ret_weights_encoded = str(*weights_encoded)
-            _weights_encoded = str(*weights_encoded)
-            string = ''
-
-            for i in range(0,len(_weights_encoded),8):
-                string = _weights_encoded[i:i+8]
-                codes.append(string)
-                #print("Enc:")
-                #print(string)
-                string =''
-
-
-            for i in codes:
-                content.append(decode(i))
-
-            string = ''
-            for i in content:
-                string += i
-
-            string = string[:effectivetritsperword*2]
-
-        else:
-            string = ''
-            for i in range(effectivetritsperword):
-                string += 'XX'
+            ret_weights_encoded = weightmem[int(prev_addr[n])].copy()
+            words[n] = ret_weights_encoded
 
         if(write_enable_ == 1):
-            st = ''
-            for j in range(numdecoders):
-                for i in range(8):
-                    st += str(wdata[n][j][i])
-
-            weightmem[write_addr[n]] = st
+            weightmem[int(write_addr[n])] = wdata_packed[n]
 
         ready_ = ~rw_collision_ & read_enable_
 
         _read_enable.append(read_enable_)
         _ready = ready_
         _collisions.append(rw_collision_)
-        _strings.append(string)
 
-    # Next state calculation
+    if (prev_ready == 1):
+        trits = decode_codes(words, decoding_table)[:, :effectivetritsperword]
+    else:
+        trits = 2*np.ones((numbanks, effectivetritsperword), dtype=int)
 
-    ___strings = []
-    __strings = (np.asarray(_strings)).reshape(numbanks,-1)
-    for i in range(__strings.shape[0]):
-        ___strings.append(__strings[(i+numbanks)%numbanks])
+    # Next state calculation
 
-    array = []
-    for string in ___strings:
-        for x in range(0,len(*string),2):
-            array.append(parse_ternary(string[0][x:x+2]))
-    trits = np.asarray(array)
     trits = trits.reshape(-1)
 
     prev_addr = read_addr
 
     #ACQUISITION
 
-    encoded = np.empty(physicalbitsperword,dtype=int)
-
-    for i in range(len(str(ret_weights_encoded)[:physicalbitsperword])):
-        if (str(ret_weights_encoded)[:physicalbitsperword][i] == '1'):
-            encoded[i] = 1
-        else:
-            encoded[i] = 0
-
-    external_weights = encoded
+    external_weights = np.unpackbits(ret_weights_encoded).astype(int)
 
     if(prev_command_source == 1):
         external_valid = (prev_external_we+1)%2
@@ -343,7 +300,7 @@ def rand_test_case():
     external_we = 0
     external_req = 0
     external_addr = 0
-    external_wdata = 0
+    external_wdata = np.zeros((numdecoders,8), dtype=int)
 
     read_enable = np.random.randint(0,2,numbanks)
 
@@ -361,7 +318,7 @@ def write_mem_rand(addr,bank,membank):
     external_we = 0
     external_req = 0
     external_addr = 0
-    external_wdata = 0
+    external_wdata = np.zeros((numdecoders,8), dtype=int)
 
     read_enable = np.zeros(numbanks, dtype=int)
 
@@ -458,14 +415,8 @@ def gen_stimuli(name_stimuli, name_exp, num_vectors):
     outputs = []
     inputs = []
 
-    f = open(name_stimuli, 'w+')
-    g = open(name_exp, 'w+')
-    if(args.json == True):
-        j_input = open(jsonIn, 'w+')
-        j_output = open(jsonOut, 'w+')
-    else:
-        j_input = open(jsonIn, 'r')
-        j_output = open(jsonOut, 'r')
+    f = LineWriter(open(name_stimuli, 'w+'))
+    g = LineWriter(open(name_exp, 'w+'))
 
     for n in range(numbanks):
         for i in range(bankdepth):
@@ -478,13 +429,13 @@ def gen_stimuli(name_stimuli, name_exp, num_vectors):
             vprint(curr_input)
             vprint(format_input(curr_input))
 
-            #jprint(j_input, curr_input)
+            #tprint(j_input, curr_input)
 
             vprint(curr_output)
             vprint(format_output(curr_output))
 
-            f.write("%s \n" % format_input(curr_input))
-            g.write("%s \n" % format_output(curr_output))
+            f.write_line(format_input(curr_input))
+            g.write_line(format_output(curr_output))
 
     for i in tqdm(range(num_vectors)):
         curr_input = rand_test_case()
@@ -496,47 +447,44 @@ def gen_stimuli(name_stimuli, name_exp, num_vectors):
         vprint(curr_input)
         vprint(format_input(curr_input))
 
-        jprint(j_input, curr_input)
+        tprint(j_input, curr_input)
 
         vprint(curr_output)
         vprint(format_output(curr_output))
 
-        jprint(j_output, curr_output)
+        tprint(j_output, curr_output)
 
-        f.write("%s \n" % format_input(curr_input))
-        g.write("%s \n" % format_output(curr_output))
+        f.write_line(format_input(curr_input))
+        g.write_line(format_output(curr_output))
 
     f.close()
     g.close()
 
-    j_input.close()
-    j_output.close()
-
 def parse_stimuli(name_stimuli, name_exp, num_vectors):
 
     outputs = []
     inputs = []
 
-    f = open(name_stimuli, 'r')
-    g = open(name_exp, 'w+')
+    stimuli = parse_stimuli_file(name_stimuli, inputtypes, inputwidths)
+    g = LineWriter(open(name_exp, 'w+'))
 
-    for i in tqdm(range(num_vectors)):
-        curr_input = parse_input(f)
+    # Every cycle of the file is replayed, including the memory writes before the num_vectors test cases
+    for i in tqdm(range(num_cycles(stimuli))):
+        curr_input = select_cycle(stimuli, i)
         curr_output = tick(curr_input)
 
         vprint(curr_input)
         vprint(format_input(curr_input))
 
-        jprint(j_input, curr_input)
+        tprint(j_input, curr_input)
 
         vprint(curr_output)
         vprint(format_output(curr_output))
 
-        jprint(j_output, curr_output)
+        tprint(j_output, curr_output)
 
-        g.write("%s \n" % format_output(curr_output))
+        g.write_line(format_output(curr_output))
 
-    f.close()
     g.close()
 
 ### END STIMULI GENERATION FUNCTION ###
@@ -547,9 +495,9 @@ if __name__=='__main__':
 
     parser = argparse.ArgumentParser(description="Stimuli generator for")
     parser.add_argument('-v', '--verbose', metavar='verbosity', dest='verbosity',  type=str2bool, const=True, default=False, nargs='?', help='Enable command line output')
-    parser.add_argument('-j', '--json', metavar='jsonOutputEnable', dest='json',  type=str2bool, const=True, default=True, nargs='?', help='Enable JSON output')
-    parser.add_argument('-jIn', '--jsonInputFile', metavar='jsonInputFile', dest='jIn',  default=str(filename)+'_json_in.txt', help='Choose your own JSON input destination file')
-    parser.add_argument('-jOut', '--jsonOutputFile', metavar='jsonOutputFile', dest='jOut',  default=str(filename)+'_json_out.txt', help='Choose your own JSON output destination file')
+    parser.add_argument('-j', '--json', metavar='jsonOutputEnable', dest='json',  type=str2bool, const=True, default=True, nargs='?', help='Enable trace output')
+    parser.add_argument('-jIn', '--jsonInputFile', metavar='jsonInputFile', dest='jIn',  default=str(filename)+'_trace_in', help='Choose your own input trace destination directory')
+    parser.add_argument('-jOut', '--jsonOutputFile', metavar='jsonOutputFile', dest='jOut',  default=str(filename)+'_trace_out', help='Choose your own output trace destination directory')
     parser.add_argument('-i', '--input', metavar='inputGeneration', dest='input',  type=str2bool, const=True, default=False, nargs='?', help='Set whether to read inputs from stimuli file or generate randomly. Default is false, meaning stimuli are generated, not read')
     parser.add_argument('-s', '--stimuli', metavar='StimuliFile', dest='stimulifile',  default=str(filename)+'_stimuli.txt', help='Choose your own stimuli output file, default is ocu_pool_weights_stimuli.txt')
     parser.add_argument('-o', '--output', metavar='OutputFile', dest='outputfile', default=str(filename)+'_exp_responses.txt', help='Choose your own expected responses output file destination, default is ocu_pool_weights_exp_responses.txt')
@@ -578,22 +526,24 @@ if __name__=='__main__':
     jsonOut = args.jOut
 
     config_module_state()
-    codebook, orig_codebook = gen_codebook()
+    config_utils_state(args, inputtypes, inputwidths, outputtypes, outputwidths)
+    encoding_table, decoding_table = load_codebook_tables()
 
     if(args.json == True):
-        j_input = open(jsonIn, 'w+')
-        j_output = open(jsonOut, 'w+')
+        j_input = TraceWriter(jsonIn)
+        j_output = TraceWriter(jsonOut)
     else:
-        j_input = open(jsonIn, 'r')
-        j_output = open(jsonOut, 'r')
+        j_input = None
+        j_output = None
 
     if(args.input == False):
         gen_stimuli(args.stimulifile,args.outputfile,numvec)
     else:
         parse_stimuli(args.stimulifile,args.outputfile,numvec)
 
-    j_input.close()
-    j_output.close()
+    if(args.json == True):
+        j_input.close()
+        j_output.close()
 
 
 ### END PROGRAM ENTRY POINT ###
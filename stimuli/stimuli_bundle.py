@@ -0,0 +1,213 @@
+# ----------------------------------------------------------------------
+#
+# File: stimuli_bundle.py
+#
+# Last edited: 17.10.2026
+#
+# Copyright (C) 2026, ETH Zurich and University of Bologna.
+#
+# Author: Moritz Scherer, ETH Zurich
+#
+# ----------------------------------------------------------------------
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the License); you may
+# not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an AS IS BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This module stores the system level stimuli of compute_tcn.py as a directory of
+# memory-mappable numpy arrays and exports them to the $readmemb text files on demand.
+
+import os
+import json
+import argparse
+import numpy as np
+from collections import namedtuple
+
+from utils import *
+
+bundle_version = 1
+bundle_name = 'stimuli_bundle'
+meta_name = 'meta.json'
+
+# Number of rows that are rendered at once when exporting text files
+chunksize = 2**16
+
+### ARTIFACT DESCRIPTIONS ###
+
+# readmemb artifacts are rendered with format_signals, every field is stored as one array
+# named <source>.<field>. Fields of single bits can be stored packed with np.packbits,
+# the number of bits is kept in the description.
+def gen_readmemb_meta(source, signaltypes, signalwidths, packed=None):
+    packed = packed or {}
+    fields = [[j, getattr(signaltypes, j), int(getattr(signalwidths, j)[0]), int(packed.get(j, 0))] for j in signaltypes._fields]
+    return {'kind': 'readmemb', 'source': source, 'fields': fields}
+
+# intf artifacts are comma separated, 'd' columns are decimal numbers, 'x' columns are
+# packed bit arrays that are printed as 32 bit hex words
+def gen_intf_meta(source, columns):
+    return {'kind': 'intf', 'source': source, 'columns': [list(j) for j in columns]}
+
+# values artifacts are small enough to keep them in the metadata header directly
+def gen_values_meta(lines):
+    return {'kind': 'values', 'lines': [[int(j) for j in line] for line in lines]}
+
+### END ARTIFACT DESCRIPTIONS ###
+
+### BUNDLE STORAGE ###
+
+# Files are written to a temporary name and then replaced, so stimuli that are hardlinked
+# to a cache are never overwritten in place
+def _open_replace(filename, mode='w'):
+    return open("%s.%d.tmp" % (filename, os.getpid()), mode)
+
+def _close_replace(f, filename):
+    f.close()
+    os.replace(f.name, filename)
+
+# Arrays that are too large to build in memory are filled in chunks through a memory map of their
+# temporary file, save_bundle moves the file in place
+def open_array(dirname, name, dtype, shape):
+    os.makedirs(dirname, exist_ok=True)
+    filename = "%s.%d.tmp" % (os.path.join(dirname, name + '.npy'), os.getpid())
+    return np.lib.format.open_memmap(filename, mode='w+', dtype=dtype, shape=shape)
+
+# keep names arrays of a previous bundle in dirname that stay part of the bundle as they are
+def save_bundle(dirname, arrays, meta, keep=()):
+    os.makedirs(dirname, exist_ok=True)
+
+    for name, array in arrays.items():
+        filename = os.path.join(dirname, name + '.npy')
+        if(isinstance(array, np.memmap) and array.filename == os.path.abspath("%s.%d.tmp" % (filename, os.getpid()))):
+            array.flush()
+            os.replace(array.filename, filename)
+            continue
+        f = _open_replace(filename, 'wb')
+        np.save(f, np.ascontiguousarray(array))
+        _close_replace(f, filename)
+
+    meta = dict(meta, version=bundle_version, arrays=sorted(set(arrays) | set(keep)))
+    filename = os.path.join(dirname, meta_name)
+    f = _open_replace(filename)
+    json.dump(meta, f, indent=1)
+    _close_replace(f, filename)
+
+def load_bundle(dirname):
+    with open(os.path.join(dirname, meta_name), 'r') as f:
+        meta = json.load(f)
+
+    if(meta['version'] != bundle_version):
+        raise ValueError("Stimuli bundle %s has version %d, expected %d" % (dirname, meta['version'], bundle_version))
+
+    arrays = {}
+    for name in meta['arrays']:
+        arrays[name] = np.load(os.path.join(dirname, name + '.npy'), mmap_mode='r')
+
+    return arrays, meta
+
+### END BUNDLE STORAGE ###
+
+### TEXT EXPORT ###
+
+def _export_readmemb(f, arrays, artifact):
+    source = artifact['source']
+    names = [field[0] for field in artifact['fields']]
+    _fields = namedtuple("_fields", names)
+
+    signaltypes = _fields(*[field[1] for field in artifact['fields']])
+    signalwidths = _fields(*[(field[2], 1) for field in artifact['fields']])
+
+    numrows = len(arrays[source + '.' + names[0]])
+    for start in range(0, numrows, chunksize):
+        values = []
+        for name, _type, bitwidth, packed in artifact['fields']:
+            chunk = np.asarray(arrays[source + '.' + name][start:start + chunksize])
+            if(packed > 0):
+                chunk = np.unpackbits(chunk, axis=-1, count=packed)
+            values.append(chunk)
+
+        f.write_rows(format_signals_batch(_fields(*values), signaltypes, signalwidths))
+
+# Splits rows of nbits bits into 32 bit words, a last partial word holds its bits right-aligned
+def bits_to_words(bits, nbits):
+    numwords = -(-nbits // 32)
+    words = np.zeros((bits.shape[0], numwords * 32), dtype=np.uint8)
+    offset = numwords * 32 - nbits
+    words[:, :(numwords-1)*32] = bits[:, :(numwords-1)*32]
+    words[:, (numwords-1)*32 + offset:] = bits[:, (numwords-1)*32:nbits]
+    return np.packbits(words, axis=-1).view('>u4').astype(np.int64)
+
+def _export_intf(f, arrays, artifact):
+    source = artifact['source']
+    columns = artifact['columns']
+
+    fmt = []
+    for column in columns:
+        if(column[1] == 'x'):
+            fmt += ["%08x"] * (-(-column[2] // 32))
+        else:
+            fmt.append("%d")
+    fmt = ",".join(fmt)
+
+    numrows = len(arrays[source + '.' + columns[0][0]])
+    for start in range(0, numrows, chunksize):
+        chunks = []
+        for column in columns:
+            chunk = np.asarray(arrays[source + '.' + column[0]][start:start + chunksize])
+            if(column[1] == 'x'):
+                chunks.append(bits_to_words(np.unpackbits(chunk, axis=-1, count=column[2]), column[2]))
+            else:
+                chunks.append(np.asarray(chunk, dtype=np.int64).reshape(-1, 1))
+
+        f.write_formatted(fmt, np.concatenate(chunks, axis=1))
+
+def _export_values(f, artifact):
+    for line in artifact['lines']:
+        f.write_line(",".join([str(j) for j in line]))
+
+def export_artifacts(outdir, arrays, meta, names=None):
+    for name, artifact in meta['artifacts'].items():
+        if(names is not None and name not in names):
+            continue
+
+        filename = os.path.join(outdir, name)
+        if(artifact['kind'] == 'readmemb'):
+            f = LineWriter(_open_replace(filename))
+            _export_readmemb(f, arrays, artifact)
+        elif(artifact['kind'] == 'intf'):
+            f = LineWriter(_open_replace(filename), suffix="\n")
+            _export_intf(f, arrays, artifact)
+        else:
+            f = LineWriter(_open_replace(filename), suffix="\n")
+            _export_values(f, artifact)
+        f.flush()
+        _close_replace(f.f, filename)
+
+def export_bundle(dirname, outdir, names=None):
+    arrays, meta = load_bundle(dirname)
+    export_artifacts(outdir, arrays, meta, names)
+
+### END TEXT EXPORT ###
+
+### PROGRAM ENTRY POINT ###
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Exports a stimuli bundle of compute_tcn.py to the $readmemb text files")
+    parser.add_argument('-b', '--bundle', metavar='BundleDir', dest='bundle', default=bundle_name, help='Choose the stimuli bundle to export, default is '+bundle_name)
+    parser.add_argument('-o', '--output', metavar='OutputDir', dest='outdir', default='.', help='Choose the directory the text files are written to')
+    parser.add_argument('-a', '--artifacts', metavar='Artifacts', dest='artifacts', nargs='*', default=None, help='Only export the given text files, e.g. weights.txt')
+
+    args = parser.parse_args()
+
+    export_bundle(args.bundle, args.outdir, args.artifacts)
+
+### END PROGRAM ENTRY POINT ###
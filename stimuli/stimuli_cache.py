@@ -0,0 +1,157 @@
+# ----------------------------------------------------------------------
+#
+# File: stimuli_cache.py
+#
+# Last edited: 17.10.2026
+#
+# Copyright (C) 2026, ETH Zurich and University of Bologna.
+#
+# Author: Moritz Scherer, ETH Zurich
+#
+# ----------------------------------------------------------------------
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the License); you may
+# not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an AS IS BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This module caches the stimuli sets of compute_tcn.py. The seeds are fixed, so a set is
+# fully determined by the accelerator config, the network, the seeds, the decoder tables
+# and the generator itself. Every set is stored in a directory named after the hash of
+# these inputs, a cache hit hardlinks the stored files to their destination.
+
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+import torch
+
+cache_version = 1
+cache_name = '.stimuli_cache'
+# Default size limit of the cache in MiB, the least recently used sets are evicted first
+cache_size = 2048
+
+config_file = '../conf/cutie_config.py'
+decoder_files = ['decoder_stimuli.txt', 'decoder_exp_responses.txt']
+# Every module compute_tcn.py imports, the gen_* modules define the widths and types of the stimuli
+generator_files = ['compute_tcn.py', 'utils.py', 'bitplane_engine.py', 'stimuli_bundle.py', 'stimuli_cache.py',
+                   'gen_activationmemory_full_stimuli.py', 'gen_weightmemory_full_stimuli.py',
+                   'gen_ocu_pool_weights_stimuli.py', 'gen_LUCA_stimuli.py']
+
+### CACHE KEYS ###
+
+def cache_key(params, sources=generator_files):
+    # params holds everything of the run that changes the stimuli, e.g. the network spec and the seeds,
+    # sources are the generator modules the stimuli depend on
+    digest = hashlib.sha256()
+    digest.update(json.dumps({'version': cache_version, 'numpy': np.__version__, 'torch': torch.__version__,
+                              'params': params}, sort_keys=True).encode())
+
+    sourcedir = os.path.dirname(os.path.abspath(__file__))
+    for name in [config_file] + decoder_files + [os.path.join(sourcedir, j) for j in sources]:
+        with open(name, 'rb') as f:
+            digest.update(f.read())
+
+    return digest.hexdigest()
+
+### END CACHE KEYS ###
+
+### CACHE STORAGE ###
+
+def _entry_files(entry):
+    for root, dirs, files in os.walk(entry):
+        for j in files:
+            yield os.path.relpath(os.path.join(root, j), entry)
+
+def link_file(src, dst):
+    # Renaming a link over another link of the same file does nothing, the destination is up to date
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        return
+    # Link to a temporary name first so the destination is replaced, not overwritten in place
+    tmpfile = "%s.%d.tmp" % (dst, os.getpid())
+    try:
+        os.link(src, tmpfile)
+    except OSError:
+        shutil.copy2(src, tmpfile)
+    os.replace(tmpfile, dst)
+
+def cache_lookup(cachedir, key, outdir, outputs=None):
+    # Links the stored files and directories of a set to outdir, outputs maps names that go
+    # somewhere else to their destination. Returns False if the set is not cached.
+    outputs = outputs or {}
+    entry = os.path.join(cachedir, key)
+    if not os.path.isdir(entry):
+        return False
+
+    try:
+        for name in os.listdir(entry):
+            src = os.path.join(entry, name)
+            dst = outputs.get(name, os.path.join(outdir, name))
+            if os.path.isdir(src):
+                shutil.rmtree(dst, ignore_errors=True)
+                for j in _entry_files(src):
+                    os.makedirs(os.path.dirname(os.path.join(dst, j)), exist_ok=True)
+                    link_file(os.path.join(src, j), os.path.join(dst, j))
+            else:
+                link_file(src, dst)
+        # The entry directory's mtime marks its last use
+        os.utime(entry)
+    except FileNotFoundError:
+        # The set was evicted by another run while we linked it
+        return False
+
+    return True
+
+def cache_store(cachedir, key, outputs, maxsize=cache_size):
+    # outputs maps the names the files and directories are stored under to their current path
+    entry = os.path.join(cachedir, key)
+    tmpentry = "%s.%d.tmp" % (entry, os.getpid())
+    shutil.rmtree(tmpentry, ignore_errors=True)
+    os.makedirs(tmpentry)
+
+    for name, src in outputs.items():
+        if os.path.isdir(src):
+            shutil.copytree(src, os.path.join(tmpentry, name))
+        else:
+            shutil.copy2(src, os.path.join(tmpentry, name))
+
+    try:
+        os.rename(tmpentry, entry)
+    except OSError:
+        # Another run stored the same set in the meantime
+        shutil.rmtree(tmpentry, ignore_errors=True)
+
+    evict(cachedir, maxsize, keep=key)
+
+def evict(cachedir, maxsize=cache_size, keep=None):
+    # Removes the least recently used sets until the cache holds at most maxsize MiB
+    entries = []
+    for key in os.listdir(cachedir):
+        entry = os.path.join(cachedir, key)
+        if key.endswith('.tmp') or not os.path.isdir(entry):
+            continue
+        try:
+            size = sum(os.path.getsize(os.path.join(entry, j)) for j in _entry_files(entry))
+            entries.append((os.path.getmtime(entry), size, key))
+        except FileNotFoundError:
+            pass
+
+    total = sum(j[1] for j in entries)
+    for mtime, size, key in sorted(entries):
+        if total <= maxsize * 2**20:
+            break
+        if key == keep:
+            continue
+        shutil.rmtree(os.path.join(cachedir, key), ignore_errors=True)
+        total -= size
+
+### END CACHE STORAGE ###
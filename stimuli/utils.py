@@ -24,8 +24,11 @@
 # limitations under the License.
 
 import argparse
+import hashlib
 import json
+import os
 import numpy as np
+from collections import namedtuple
 
 ### ARGPARSE INTERFACE ###
 
@@ -43,74 +46,231 @@ def vprint(_input):
     if(args.verbosity == True):
         print(_input)
 
-### END ARGPARSE INTERFACE ###
-
-def format_signals(_signals, signaltypes, signalwidths):
-    string = ""
-
-    for j in _signals._fields:
-        for i in np.nditer(getattr(_signals, j)):
-            string = string + _format(i, getattr(signaltypes, j), (getattr(signalwidths, j))[0])
-
-    return string
-
-def format_input(_input):
-
-    string = ""
-
-    for j in _input._fields:
-        for i in np.nditer(getattr(_input, j)):
-            string = string + _format(i, getattr(inputtypes, j), (getattr(inputwidths, j))[0])
+def config_utils_state(_args, _inputtypes, _inputwidths, _outputtypes, _outputwidths):
+    # The generators import these functions with *, so their own globals are not seen here
+    global args, inputtypes, inputwidths, outputtypes, outputwidths
+    args = _args
+    inputtypes = _inputtypes
+    inputwidths = _inputwidths
+    outputtypes = _outputtypes
+    outputwidths = _outputwidths
 
-    return string
-
-def format_output(_output):
-
-    string = ""
+### END ARGPARSE INTERFACE ###
 
-    for j in _output._fields:
-        for i in np.nditer(getattr(_output, j)):
-            string = string + _format(i, getattr(outputtypes, j), (getattr(outputwidths, j))[0])
+_field_layout = namedtuple("_field_layout", "name type bitwidth shifts")
 
-    return string
+_signal_layouts = {}
 
-### JSON SERIALIZATION FUNCTIONS ###
+def gen_signal_layout(signaltypes, signalwidths):
+    layout = []
 
-class NumpyEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, np.ndarray):
-            return obj.tolist()
-        if isinstance(obj, np.int64):
-            return int(obj)
-        return json.JSONEncoder.default(self, obj)
+    for j in signaltypes._fields:
+        bitwidth = int(getattr(signalwidths, j)[0])
+        shifts = np.arange(bitwidth-1, -1, -1, dtype=np.int64)
+        layout.append(_field_layout(j, getattr(signaltypes, j), bitwidth, shifts))
 
-def recursive_to_json(obj):
-    _json = {}
+    return layout
 
-    if (isinstance(obj, tuple)):
-        datas = obj._asdict()
-        for data in datas:
-            if isinstance(datas[data], tuple):
-                _json[data] = (recursive_to_json(datas[data]))
-            else:
-                _json[data] = (datas[data])
+def get_signal_layout(signaltypes, signalwidths):
+    key = (signaltypes, signalwidths)
+    if key not in _signal_layouts:
+        _signal_layouts[key] = gen_signal_layout(signaltypes, signalwidths)
+    return _signal_layouts[key]
 
-    return _json
+def format_signals_batch(_signals, signaltypes, signalwidths):
+    # Every field of _signals holds one value per cycle along its first axis,
+    # returns a (cycles, characters) uint8 matrix of the $readmemb lines
+    fields = []
 
-def jprint(f, _input):
-    if(args.json == True):
-        f.write(str(json.dumps(recursive_to_json(_input), cls=NumpyEncoder))+" \n")
+    for field in get_signal_layout(signaltypes, signalwidths):
+        values = np.asarray(getattr(_signals, field.name))
+        values = values.reshape(values.shape[0], -1)
+        if(field.type == 'ternary'):
+            fields.append(_format_ternary_batch(values))
+        else:
+            fields.append(_format_binary_batch(values, field.bitwidth, field.shifts))
 
-def jload(_file):
+    return np.concatenate(fields, axis=1)
 
-    objs = []
-    with open(_file,"r") as f:
-        for x in f:
-            objs.append(json.loads(x))
+def format_signals(_signals, signaltypes, signalwidths):
+    batch = type(_signals)(*[np.asarray(getattr(_signals, j))[np.newaxis] for j in _signals._fields])
+    return format_signals_batch(batch, signaltypes, signalwidths)[0].tobytes().decode()
 
-    return objs
+def format_input(_input):
+    return format_signals(_input, inputtypes, inputwidths)
 
-### JSON SERIALIZATION FUNCTIONS ###
+def format_output(_output):
+    return format_signals(_output, outputtypes, outputwidths)
+
+### LINE WRITER ###
+
+# Collects the lines of a stimuli or response file and writes them to the file handle in
+# blocks of at least blocksize bytes instead of once per cycle
+class LineWriter:
+    def __init__(self, f, suffix=" \n", blocksize=2**22):
+        self.f = f
+        self.suffix = suffix.encode()
+        self.blocksize = blocksize
+        self.buffer = bytearray()
+
+    def write_line(self, line):
+        self.buffer += line.encode()
+        self.buffer += self.suffix
+        if len(self.buffer) >= self.blocksize:
+            self.flush()
+
+    def write_rows(self, rows):
+        # rows is a (lines, characters) uint8 matrix as returned by format_signals_batch
+        rows = np.asarray(rows, dtype=np.uint8)
+        lines = np.empty((rows.shape[0], rows.shape[1] + len(self.suffix)), dtype=np.uint8)
+        lines[:, :rows.shape[1]] = rows
+        lines[:, rows.shape[1]:] = np.frombuffer(self.suffix, dtype=np.uint8)
+        self.buffer += lines.tobytes()
+        if len(self.buffer) >= self.blocksize:
+            self.flush()
+
+    def write_formatted(self, fmt, values):
+        # Renders every row of the 2D integer array values with the line format fmt in one operation
+        values = np.asarray(values)
+        if values.shape[0] == 0:
+            return
+        self.buffer += (((fmt + self.suffix.decode()) * values.shape[0]) % tuple(values.ravel().tolist())).encode()
+        if len(self.buffer) >= self.blocksize:
+            self.flush()
+
+    def flush(self):
+        if len(self.buffer) > 0:
+            self.f.write(self.buffer.decode())
+            self.buffer.clear()
+
+    def close(self):
+        self.flush()
+        self.f.close()
+
+### END LINE WRITER ###
+
+### TRACE FUNCTIONS ###
+
+# Traces record one namedtuple per cycle. Every (nested) field is buffered as a column and
+# written as one .npz chunk of trace_chunksize cycles, meta.json holds the length and the fields.
+trace_chunksize = 4096
+trace_meta_name = 'meta.json'
+
+def _flatten_record(obj, prefix=''):
+    fields = []
+    for name, value in obj._asdict().items():
+        if isinstance(value, tuple):
+            fields += _flatten_record(value, prefix + name + '.')
+        else:
+            fields.append((prefix + name, value))
+    return fields
+
+def _stack_column(column):
+    # Fields that are sometimes given as a scalar are broadcast to the shape of the other cycles
+    shapes = set([np.shape(j) for j in column])
+    if len(shapes) > 1:
+        shape = np.broadcast_shapes(*shapes)
+        column = [np.broadcast_to(j, shape) for j in column]
+    return np.stack(column)
+
+class TraceWriter:
+    def __init__(self, dirname, chunksize=trace_chunksize):
+        self.dirname = dirname
+        self.chunksize = chunksize
+        self.fields = None
+        self.columns = None
+        self.numchunks = 0
+        self.length = 0
+
+        os.makedirs(dirname, exist_ok=True)
+        for j in os.listdir(dirname):
+            if j.endswith('.npz'):
+                os.remove(os.path.join(dirname, j))
+
+    def append(self, record):
+        fields = _flatten_record(record)
+        if self.fields is None:
+            self.fields = [j[0] for j in fields]
+            self.columns = [[] for j in fields]
+
+        for column, (name, value) in zip(self.columns, fields):
+            column.append(value)
+
+        self.length += 1
+        if len(self.columns[0]) == self.chunksize:
+            self.flush()
+
+    def flush(self):
+        if self.fields is None or len(self.columns[0]) == 0:
+            return
+
+        arrays = {name: _stack_column(column) for name, column in zip(self.fields, self.columns)}
+        np.savez(os.path.join(self.dirname, "%06d.npz" % self.numchunks), **arrays)
+        self.numchunks += 1
+        self.columns = [[] for j in self.fields]
+
+    def close(self):
+        self.flush()
+        with open(os.path.join(self.dirname, trace_meta_name), 'w') as f:
+            json.dump({'length': self.length, 'chunksize': self.chunksize, 'fields': self.fields or []}, f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class TraceReader:
+    def __init__(self, dirname):
+        self.dirname = dirname
+        with open(os.path.join(dirname, trace_meta_name), 'r') as f:
+            meta = json.load(f)
+
+        self.length = meta['length']
+        self.chunksize = meta['chunksize']
+        self.fields = meta['fields']
+        self.chunkindex = None
+        self.chunk = None
+
+    def __len__(self):
+        return self.length
+
+    def load_chunk(self, index):
+        # Only the chunk of the last accessed cycle is kept in memory
+        if index != self.chunkindex:
+            with np.load(os.path.join(self.dirname, "%06d.npz" % index)) as chunk:
+                self.chunk = {j: chunk[j] for j in self.fields}
+            self.chunkindex = index
+        return self.chunk
+
+    def __getitem__(self, cycle):
+        if cycle < 0:
+            cycle += self.length
+        if not 0 <= cycle < self.length:
+            raise IndexError("Cycle %d is out of range for trace %s of length %d" % (cycle, self.dirname, self.length))
+
+        chunk = self.load_chunk(cycle // self.chunksize)
+        record = {}
+        for name in self.fields:
+            *parents, leaf = name.split('.')
+            node = record
+            for j in parents:
+                node = node.setdefault(j, {})
+            node[leaf] = chunk[name][cycle % self.chunksize]
+        return record
+
+    def __iter__(self):
+        for cycle in range(self.length):
+            yield self[cycle]
+
+def tprint(trace, _input):
+    if(trace is not None):
+        trace.append(_input)
+
+def tload(dirname):
+    return TraceReader(dirname)
+
+### END TRACE FUNCTIONS ###
 
 ### SERIALIZATION FUNCTIONS ###
 
@@ -149,44 +309,110 @@ def format_binary(num, bitwidth):
 
     return str(string[-bitwidth:])
 
+def _format_ternary_batch(values):
+    chars = np.full(values.shape + (2,), ord('X'), dtype=np.uint8)
+    chars[values == 1] = (ord('0'), ord('1'))
+    chars[values == 0] = (ord('0'), ord('0'))
+    chars[values == -1] = (ord('1'), ord('1'))
+    return chars.reshape(values.shape[0], -1)
+
+def _format_binary_batch(values, bitwidth, shifts):
+    # Two's complement of negative numbers, truncated to the lower bitwidth bits like format_binary
+    if(values.dtype.kind not in 'iub'):
+        values = np.trunc(values)
+    num = values.astype(np.int64) & ((1 << bitwidth) - 1)
+    bits = (num[..., np.newaxis] >> shifts) & 1
+    return (bits.astype(np.uint8) + ord('0')).reshape(values.shape[0], -1)
+
 
 ### END SERIALIZATION FUNCTIONS ###
 ### DESERIALIZATION FUNCTIONS ###
 
-def parse_input(f):
-    line = f.readline()
+_parse_field = namedtuple("_parse_field", "name type bitwidth shape offset count")
 
-    inputlist = []
+_parse_layouts = {}
 
-    for field in (inputwidths._fields):
-        if(getattr(inputwidths,field)[1] == 1):
-            currentelement = 0;
-        else:
-            currentelement = np.empty(np.prod(getattr(inputwidths,field)[1]))
+def gen_parse_layout(signaltypes, signalwidths):
+    layout = []
+    offset = 0
+
+    for j in signaltypes._fields:
+        bitwidth, shape = getattr(signalwidths, j)
+        count = int(np.prod(shape))
+        if(shape != 1):
+            shape = tuple(int(x) for x in np.atleast_1d(shape))
+        layout.append(_parse_field(j, getattr(signaltypes, j), int(bitwidth), shape, offset, count))
+        offset += int(bitwidth) * count
+
+    return layout
 
-        for width in range(np.prod(getattr(inputwidths,field)[1])):
+def get_parse_layout(signaltypes, signalwidths):
+    key = (signaltypes, signalwidths)
+    if key not in _parse_layouts:
+        _parse_layouts[key] = gen_parse_layout(signaltypes, signalwidths)
+    return _parse_layouts[key]
 
-            subline = str(line[0:getattr(inputwidths,field)[0]])
+def parse_lines(lines, signaltypes, signalwidths):
+    # lines is a (cycles, characters) uint8 matrix, returns one array per field with the cycles along the first axis
+    fieldlist = []
 
-            if(getattr(inputwidths,field)[1] == 1):
-                currentelement = _parse(subline, getattr(inputtypes,field), getattr(inputwidths,field)[0])
-            else:
-                currentelement[width] = _parse(subline, getattr(inputtypes,field), getattr(inputwidths,field)[0])
+    for field in get_parse_layout(signaltypes, signalwidths):
+        chars = lines[:, field.offset:field.offset + field.bitwidth * field.count]
+        chars = chars.reshape(lines.shape[0], field.count, field.bitwidth)
 
-            line = line[getattr(inputwidths,field)[0]:]
+        if(field.type == 'ternary'):
+            values = _parse_ternary_batch(chars)
+        else:
+            values = _parse_binary_batch(chars, field.type)
 
-        if(getattr(inputwidths,field)[1] == 1):
-            inputlist.append(currentelement)
+        if(field.shape == 1):
+            fieldlist.append(values[:, 0])
         else:
-            inputlist.append(np.reshape(currentelement,getattr(inputwidths,field)[1]))
+            fieldlist.append(values.reshape(lines.shape[0], *field.shape))
+
+    return type(signaltypes)(*fieldlist)
+
+def parse_stimuli_file(name, signaltypes, signalwidths):
+    if(os.path.getsize(name) == 0):
+        return parse_lines(np.zeros((0, 0), dtype=np.uint8), signaltypes, signalwidths)
+
+    data = np.memmap(name, dtype=np.uint8, mode='r')
+
+    # The fields are read at fixed offsets, so all lines need the length of the first one
+    newlines = np.flatnonzero(data == ord('\n'))
+    stride = int(newlines[0]) + 1 if len(newlines) > 0 else len(data)
+    misplaced = np.flatnonzero(newlines != np.arange(stride - 1, stride * len(newlines), stride))
+    if(len(misplaced) > 0 or len(data) != stride * len(newlines)):
+        line = int(misplaced[0]) if len(misplaced) > 0 else len(newlines)
+        start = int(newlines[line - 1]) + 1 if line > 0 else 0
+        end = int(newlines[line]) + 1 if line < len(newlines) else len(data)
+        raise ValueError("Stimuli file %s has lines of different lengths, line %d has %d characters, line 1 has %d"
+                         % (name, line + 1, end - start, stride))
+
+    layout = get_parse_layout(signaltypes, signalwidths)
+    linewidth = max([field.offset + field.bitwidth * field.count for field in layout])
+    if(linewidth > stride - 1):
+        raise ValueError("Stimuli file %s has lines of %d characters, its fields need %d" % (name, stride - 1, linewidth))
+
+    lines = data.reshape(-1, stride)
+
+    return parse_lines(lines, signaltypes, signalwidths)
 
-    retinput = _input(*inputlist)
+def select_cycle(_signals, cycle):
+    return type(_signals)(*[getattr(_signals, j)[cycle] for j in _signals._fields])
+
+def num_cycles(_signals):
+    return len(getattr(_signals, _signals._fields[0]))
+
+def parse_input(f):
+    line = np.frombuffer(f.readline().encode(), dtype=np.uint8)[np.newaxis]
+
+    retinput = select_cycle(parse_lines(line, inputtypes, inputwidths), 0)
 
     #vprint(retinput)
 
     return (retinput)
 
-
 def _parse(line, _type):
     if (_type == 'ternary'):
         return parse_ternary(line)
@@ -224,6 +450,22 @@ def _parse(num, _type, bitwidth=1):
     elif(_type=='signed'):
         return parse_binary(num, 'signed', bitwidth)
 
+def _parse_ternary_batch(chars):
+    values = 2*np.ones(chars.shape[:-1], dtype=int)
+    values[(chars[..., 0] == ord('0')) & (chars[..., 1] == ord('1'))] = 1
+    values[(chars[..., 0] == ord('1')) & (chars[..., 1] == ord('1'))] = -1
+    values[(chars[..., 0] == ord('0')) & (chars[..., 1] == ord('0'))] = 0
+    return values
+
+def _parse_binary_batch(chars, signedness):
+    bitwidth = chars.shape[-1]
+    values = (chars == ord('1')).astype(np.int64) @ (1 << np.arange(bitwidth-1, -1, -1, dtype=np.int64))
+
+    if(signedness == 'signed'):
+        values = np.where(values >= 2**(bitwidth-1), values - 2**bitwidth, values)
+
+    return values
+
 ### END DESERIALIZATION FUNCTIONS ###
 
 def gen_codebook(stimulifile="decoder_stimuli.txt", exp_responsesfile="decoder_exp_responses.txt"):
@@ -266,3 +508,90 @@ def gen_codebook(stimulifile="decoder_stimuli.txt", exp_responsesfile="decoder_e
 
 def decode(codebook, string):
     return codebook[string]
+
+def gen_reverse_codebook(codebook):
+    reverse_codebook = {}
+
+    for x, y in codebook.items():
+        if y not in reverse_codebook:
+            reverse_codebook[y] = x
+
+    return reverse_codebook
+
+### CODEBOOK TABLE FUNCTIONS ###
+
+# Five trits are compressed into one 8 bit code word, see decoder_stimuli.txt
+tritspercode = 5
+
+def gen_encoding_table(reverse_codebook):
+    table = np.zeros(3**tritspercode, dtype=np.uint8)
+
+    for index in range(3**tritspercode):
+        digits = [(index // 3**(tritspercode-1-i)) % 3 for i in range(tritspercode)]
+        string = "".join([format_ternary(-1 if d == 2 else d) for d in digits])
+        table[index] = int(reverse_codebook[string], 2)
+
+    return table
+
+def encode_trits(trits, table):
+    trits = np.asarray(trits, dtype=np.int8)
+    trits = trits.reshape(trits.shape[0], -1)
+    numcodes = int(np.ceil(trits.shape[1] / tritspercode))
+
+    # Pad every row with zero trits up to a full code word
+    padded = np.zeros((trits.shape[0], numcodes * tritspercode), dtype=np.int8)
+    padded[:, :trits.shape[1]] = np.where(np.abs(trits) == 1, trits, 0)
+
+    digits = (padded.reshape(-1, numcodes, tritspercode) % 3).astype(np.intp)
+    index = digits @ (3**np.arange(tritspercode-1, -1, -1))
+
+    return table[index]
+
+def gen_decoding_table(codebook):
+    # Codes that are missing in the codebook decode to the unknown trit, like parse_ternary('XX')
+    table = 2*np.ones((2**8, tritspercode), dtype=np.int8)
+
+    for code in range(2**8):
+        string = codebook.get(format(code, '08b'))
+        if string is not None:
+            table[code] = [parse_ternary(string[i:i+2]) for i in range(0, 2*tritspercode, 2)]
+
+    return table
+
+def decode_codes(codes, table):
+    codes = np.asarray(codes, dtype=np.uint8)
+    return table[codes].reshape(*codes.shape[:-1], -1)
+
+def trits_to_bits(trits):
+    trits = np.asarray(trits)
+    bits = np.stack(((trits == -1), (np.abs(trits) == 1)), axis=-1)
+    return bits.reshape(*trits.shape[:-1], -1).astype(np.uint8)
+
+def load_codebook_tables(stimulifile="decoder_stimuli.txt", exp_responsesfile="decoder_exp_responses.txt", cachefile="decoder_tables.npz"):
+    # The compiled tables are only valid for the decoder tables they were built from
+    digest = hashlib.sha1()
+    for name in (stimulifile, exp_responsesfile):
+        with open(name, 'rb') as f:
+            digest.update(f.read())
+    key = digest.hexdigest()
+
+    try:
+        with np.load(cachefile) as tables:
+            if str(tables['key']) == key:
+                return tables['encoding'], tables['decoding']
+    except (OSError, KeyError, ValueError):
+        pass
+
+    codebook, orig_codebook = gen_codebook(stimulifile, exp_responsesfile)
+    encoding_table = gen_encoding_table(gen_reverse_codebook(codebook))
+    decoding_table = gen_decoding_table(codebook)
+
+    # Write to a temporary file first so concurrent generator runs never see a partial cache
+    tmpfile = "%s.%d.tmp" % (cachefile, os.getpid())
+    with open(tmpfile, 'wb') as f:
+        np.savez(f, key=key, encoding=encoding_table, decoding=decoding_table)
+    os.replace(tmpfile, cachefile)
+
+    return encoding_table, decoding_table
+
+### END CODEBOOK TABLE FUNCTIONS ###